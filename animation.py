@@ -0,0 +1,169 @@
+import collections
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+import logging
+from distutils.spawn import find_executable
+from subprocess import check_call
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from files import load_thumbnail
+
+logger = logging.getLogger('photobooth.animation')
+
+ANIMATION_MAX_SIZE = 800
+FRAME_TIME = 0.5
+ANIMATION_WORKERS = 1
+# Encoding is the least urgent thing the booth does
+WORKER_NICENESS = 10
+MP4_FPS = 25
+STATS_SAMPLES = 50
+
+
+def load_frames(paths, max_size):
+    return [load_thumbnail(path, (max_size, max_size)) for path in paths]
+
+
+def encode_gif(paths, out_path, max_size, frame_time):
+    frames = [frame.convert('P', palette=Image.ADAPTIVE)
+              for frame in load_frames(paths, max_size)]
+    frames[0].save(out_path, 'GIF', save_all=True, append_images=frames[1:],
+                   duration=int(frame_time * 1000), loop=0)
+
+
+def encode_mp4(paths, out_path, max_size, frame_time):
+    frame_dir = tempfile.mkdtemp()
+    try:
+        for count, frame in enumerate(load_frames(paths, max_size)):
+            frame.save(os.path.join(frame_dir, '%03d.jpg' % count), 'JPEG', quality=95)
+        check_call(['ffmpeg', '-y', '-loglevel', 'error',
+                    '-framerate', str(1.0 / frame_time),
+                    '-i', os.path.join(frame_dir, '%03d.jpg'),
+                    # x264 needs even dimensions
+                    '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2',
+                    '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-r', str(MP4_FPS),
+                    out_path])
+    finally:
+        shutil.rmtree(frame_dir)
+
+
+ENCODERS = {
+    'gif': encode_gif,
+    'mp4': encode_mp4,
+}
+
+
+def encode(fmt, paths, out_path, max_size, frame_time):
+    """
+    Runs in a worker process. Returns the encode time and file size, or
+    None and the traceback if it failed.
+    """
+    start = time.time()
+    try:
+        ENCODERS[fmt](paths, out_path, max_size, frame_time)
+    except Exception:
+        return None, traceback.format_exc()
+    return time.time() - start, os.path.getsize(out_path)
+
+
+def lower_priority():
+    os.nice(WORKER_NICENESS)
+
+
+class AnimationMaker(object):
+    """
+    Turns a session's captures into a looping GIF, or an MP4 if ffmpeg is
+    installed, in a pool of low priority worker processes so encoding
+    never holds up the UI.
+
+    on_done is called with the path of each finished animation, from a
+    pool thread.
+    """
+    def __init__(self, fmt='gif', on_done=None, max_size=ANIMATION_MAX_SIZE,
+                 frame_time=FRAME_TIME, workers=ANIMATION_WORKERS):
+        if Image is None:
+            raise Exception("PIL is needed to make animations")
+        if fmt == 'mp4' and not find_executable('ffmpeg'):
+            logger.warn("ffmpeg not found, making GIFs instead of MP4s")
+            fmt = 'gif'
+        self.format = fmt
+        self.on_done = on_done
+        self.max_size = max_size
+        self.frame_time = frame_time
+        self.workers = workers
+        self.pool = None
+
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.history = collections.deque(maxlen=STATS_SAMPLES)
+
+    def start(self):
+        # Before the display is opened, so the workers don't inherit it
+        self.pool = multiprocessing.Pool(self.workers, lower_priority)
+
+    def stop(self):
+        """
+        Wait for everything already submitted to be encoded.
+        """
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+
+    def submit(self, paths, out_path):
+        out_dir = os.path.dirname(out_path)
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        with self.lock:
+            self.pending += 1
+        submitted = time.time()
+
+        def finished(result):
+            self.finished(out_path, submitted, *result)
+
+        self.pool.apply_async(encode, (self.format, paths, out_path, self.max_size,
+                                       self.frame_time), callback=finished)
+
+    def finished(self, out_path, submitted, encode_time, result):
+        with self.lock:
+            self.pending -= 1
+            if encode_time is None:
+                self.failed += 1
+            else:
+                self.completed += 1
+                self.history.append({
+                    'path': out_path,
+                    'encode_time': encode_time,
+                    'bytes': result,
+                    'latency': time.time() - submitted,
+                })
+        if encode_time is None:
+            logger.error("Failed to make %s:\n%s", out_path, result)
+            return
+
+        logger.info("Made %s in %.2fs, %d bytes", out_path, encode_time, result)
+        if self.on_done:
+            self.on_done(out_path)
+
+    def stats(self):
+        with self.lock:
+            history = list(self.history)
+            stats = {
+                'format': self.format,
+                'pending': self.pending,
+                'completed': self.completed,
+                'failed': self.failed,
+            }
+        if history:
+            stats['mean_encode_time'] = sum(item['encode_time'] for item in history) / len(history)
+            stats['mean_bytes'] = sum(item['bytes'] for item in history) / len(history)
+        return stats
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+Runs whole photo sessions through the booth without a screen, camera or
+button: the dummy SDL driver, recorded live view frames, a button that
+is pressed whenever the booth is waiting for it and short timers.
+
+Reports frame rate, session time, composition time and peak memory, so
+changes to the booth can be compared from one run to the next.
+"""
+
+import argparse
+import glob
+import itertools
+import os
+import resource
+import shutil
+import StringIO
+import tempfile
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import pygame
+
+from button import BUTTON_EVENT
+from cameras import DebugCamera
+from printer import FilePrinter
+from photobooth import PhotoBooth, WaitingState
+
+
+class ReplayCamera(DebugCamera):
+    """
+    Plays back recorded live view frames in a loop, and returns the same
+    capture for every shot.
+    """
+    def __init__(self, frames, capture, capture_delay=0):
+        self.frames = itertools.cycle(frames)
+        self.capture = capture
+        self.capture_delay = capture_delay
+
+    def capture_preview_data(self):
+        return next(self.frames)
+
+    def capture_image_data(self, more_to_come=False):
+        time.sleep(self.capture_delay)
+        return self.capture, pygame.image.load(StringIO.StringIO(self.capture))
+
+    def sleep(self):
+        pass
+
+
+class BenchBooth(PhotoBooth):
+    def __init__(self, window_size, sessions, *args, **kwargs):
+        super(BenchBooth, self).__init__(*args, **kwargs)
+        self.window_size = window_size
+        self.sessions_wanted = sessions
+        self.session_times = []
+        self.session_started = None
+        self.frames = 0
+        self.started = None
+
+    def open_display(self):
+        # The dummy driver has no screen size to go on, and would be 8 bit
+        pygame.display.set_mode(self.window_size, 0, 32)
+
+    def add_button_listener(self):
+        pass
+
+    def main_loop(self):
+        if self.started is None:
+            self.started = time.time()
+        session = self.current_session
+        if session is None or isinstance(session.state, WaitingState):
+            pygame.event.post(pygame.event.Event(BUTTON_EVENT))
+
+        running = super(BenchBooth, self).main_loop()
+        self.frames += 1
+
+        if self.current_session is not session:
+            now = time.time()
+            if session is not None:
+                self.session_times.append(now - self.session_started)
+            self.session_started = now
+        return running and len(self.session_times) < self.sessions_wanted
+
+
+def report(booth, elapsed):
+    times = booth.session_times
+    print 'Sessions:    %d, mean %.2fs, min %.2fs, max %.2fs' % (
+        len(times), sum(times) / len(times), min(times), max(times))
+    print 'Frames:      %d in %.1fs, %.1f fps' % (booth.frames, elapsed, booth.frames / elapsed)
+    work = booth.pacer.stats()
+    print 'Frame work:  p50 %.1fms, p90 %.1fms, p99 %.1fms, max %.1fms' % (
+        work['p50'], work['p90'], work['p99'], work['max'])
+    preview = booth.preview.stats()
+    print 'Preview:     %d frames, %d dropped, %d errors' % (
+        preview['frames'], preview['dropped'], preview['errors'])
+    for stage, mean in sorted(booth.jobs.stats()['mean_stage_times'].items()):
+        print 'Job %-14s mean %.3fs' % (stage + ':', mean)
+    if booth.animator:
+        print 'Animations:  %s' % booth.animator.stats()
+    # Kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print 'Peak memory: %.1fMB' % (peak / 1024.0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("frames", help="Folder of recorded preview JPEGs")
+    parser.add_argument("capture", help="A full size capture, used for every shot")
+    parser.add_argument("-n", "--sessions", type=int, default=3, help="Sessions to run")
+    parser.add_argument("-s", "--size", default="1920x1080", help="Screen size")
+    parser.add_argument("--countdown", type=float, default=1, help="Countdown seconds")
+    parser.add_argument("--show_time", type=float, default=0.5,
+                        help="Seconds each capture is shown for")
+    parser.add_argument("--montage_time", type=float, default=2,
+                        help="Seconds the montage is shown for")
+    parser.add_argument("--capture_delay", type=float, default=0,
+                        help="Seconds the camera takes to capture")
+    parser.add_argument("--shots", type=int, default=4, help="Photos per session")
+    parser.add_argument("--burst", action="store_true", help="Take photos in a burst")
+    parser.add_argument("--animation", choices=['gif', 'mp4'], help="Make animations too")
+    parser.add_argument("--dirty_rects", action="store_true", help="Only redraw what changed")
+    parser.add_argument("--profile", help="CSV file to write frame timings to")
+    args = parser.parse_args()
+    if args.shots < 1:
+        parser.error("--shots must be at least 1")
+
+    size = tuple(int(x) for x in args.size.split('x'))
+
+    frames = []
+    for path in sorted(glob.glob(os.path.join(args.frames, '*.jpg'))):
+        with open(path, 'rb') as f:
+            frames.append(f.read())
+    if not frames:
+        parser.error("No .jpg files found in " + args.frames)
+    with open(args.capture, 'rb') as f:
+        capture = f.read()
+
+    out_dir = tempfile.mkdtemp()
+    try:
+        booth = BenchBooth(size, args.sessions, out_dir,
+                           fullscreen=False,
+                           debug=False,
+                           camera=ReplayCamera(frames, capture, args.capture_delay),
+                           printer=FilePrinter(),
+                           upload_to=None,
+                           dirty_rects=args.dirty_rects,
+                           shot_count=args.shots,
+                           burst=args.burst,
+                           burst_interval=args.show_time,
+                           animation=args.animation,
+                           profile_path=args.profile)
+        booth.count_down_time = args.countdown
+        booth.image_display_time = args.show_time
+        booth.montage_display_time = args.montage_time
+
+        booth.start()
+        report(booth, time.time() - booth.started)
+    finally:
+        shutil.rmtree(out_dir)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Times turning recorded live view frames into screen sized, mirrored
+surfaces: the old load/scale/flip path against PreviewDecoder.
+"""
+
+import argparse
+import glob
+import os
+import StringIO
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import pygame
+
+from preview import PreviewDecoder, Image
+
+
+def old_path(size):
+    def decode(data):
+        picture = pygame.image.load(StringIO.StringIO(data))
+        picture = pygame.transform.scale(picture, size)
+        return pygame.transform.flip(picture, True, False)
+    return decode
+
+
+def time_frames(frames, decode, runs):
+    start = time.time()
+    for _ in range(runs):
+        for data in frames:
+            decode(data)
+    return (time.time() - start) / (runs * len(frames))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("frames", help="Folder of recorded preview JPEGs")
+    parser.add_argument("-s", "--size", default="1920x1080", help="Screen size to decode to")
+    parser.add_argument("-r", "--runs", type=int, default=5, help="Passes over the frames")
+    args = parser.parse_args()
+
+    size = tuple(int(x) for x in args.size.split('x'))
+
+    pygame.init()
+    pygame.display.set_mode(size, 0, 32)
+
+    frames = []
+    for path in sorted(glob.glob(os.path.join(args.frames, '*.jpg'))):
+        with open(path, 'rb') as f:
+            frames.append(f.read())
+    if not frames:
+        parser.error("No .jpg files found in " + args.frames)
+
+    print '%d frames to %dx%d, %d runs' % ((len(frames),) + size + (args.runs,))
+    paths = [('load/scale/flip', old_path(size)),
+             ('decoder pygame', PreviewDecoder(size, use_pil=False).decode)]
+    if Image:
+        paths.append(('decoder PIL', PreviewDecoder(size).decode))
+    else:
+        print 'PIL not found, skipping the PIL decoder'
+
+    for name, decode in paths:
+        per_frame = time_frames(frames, decode, args.runs)
+        print '%-16s %.1fms per frame (%.0f fps)' % (name, per_frame * 1000, 1 / per_frame)
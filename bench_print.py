@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Compares making the print sized image with ImageMagick's convert (the old
+way) against cropping the combined image in memory.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from distutils.spawn import find_executable
+from subprocess import call
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import pygame
+
+from montage import scale_to_fill
+
+PRINT_IMAGE_SIZE = (2136, 1424)
+
+
+def time_runs(runs, func):
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return times
+
+
+def report(name, times):
+    times = sorted(times)
+    print '%-12s mean %.3fs  min %.3fs  max %.3fs' % (
+        name, sum(times) / len(times), times[0], times[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("combined", help="A combined image to make print copies of")
+    parser.add_argument("-r", "--runs", type=int, default=10, help="Number of runs of each")
+    args = parser.parse_args()
+
+    pygame.init()
+    out_dir = tempfile.mkdtemp()
+    try:
+        combined = pygame.image.load(args.combined)
+        out_path = os.path.join(out_dir, 'print.jpg')
+        size = '%dx%d' % PRINT_IMAGE_SIZE
+
+        def subprocess_path():
+            # The montage had to be saved first, then convert read it back
+            pygame.image.save(combined, os.path.join(out_dir, 'combined.jpg'))
+            call(['convert', os.path.join(out_dir, 'combined.jpg'), '-resize', size + '^',
+                  '-gravity', 'center', '-extent', size, out_path])
+
+        def in_process_path():
+            pygame.image.save(combined, os.path.join(out_dir, 'combined.jpg'))
+            pygame.image.save(scale_to_fill(combined, PRINT_IMAGE_SIZE), out_path)
+
+        print 'Combined image %dx%d, %d runs' % (combined.get_size() + (args.runs,))
+        if find_executable('convert'):
+            report('convert', time_runs(args.runs, subprocess_path))
+        else:
+            print 'convert not found, skipping ImageMagick runs'
+        report('in process', time_runs(args.runs, in_process_path))
+    finally:
+        shutil.rmtree(out_dir)
@@ -1,30 +1,109 @@
-
+import errno
+import fcntl
 import os
+import termios
+import threading
+import time
 import logging
 
+import pygame
+
 logger = logging.getLogger('photobooth.button')
 
 DEFAULT_TTY = '/dev/ttyUSB0'
+BUTTON_EVENT = pygame.USEREVENT + 1
+DEBOUNCE_TIME = 0.03
+POLL_INTERVAL = 0.02
+REOPEN_DELAY = 2
+
+
+def post_button_event():
+    pygame.event.post(pygame.event.Event(BUTTON_EVENT))
+
+
+class Button(threading.Thread):
+    """
+    Watches the button's carrier detect line on a background thread and
+    posts a BUTTON_EVENT when it's pressed.
 
+    Blocks in the kernel until the line changes, where the serial driver
+    supports it (TIOCMIWAIT), otherwise polls. port can be anything with
+    getCD and fileno, such as a pseudo-terminal stand-in.
 
-class Button(object):
-    def __init__(self, tty=DEFAULT_TTY):
+    If the port fails, for example the adapter is unplugged, the error is
+    logged and the port reopened after a short wait.
+    """
+    def __init__(self, tty=DEFAULT_TTY, port=None, on_press=post_button_event):
+        super(Button, self).__init__(name='button')
+        self.daemon = True
         self.pressed = False
         self.tty = tty
-        self.port = None
+        self.port = port
+        self.on_press = on_press
+        self.wait_in_kernel = True
 
-        if os.path.exists(self.tty):
-            import serial
-            self.port = serial.Serial(self.tty, 9600)
-            self.port.setDTR() #level=True)
+        self.owns_port = not self.port
+        if not self.port and os.path.exists(self.tty):
+            self.open()
 
-    def is_pressed(self):
-        if self.port:
+    def open(self):
+        import serial
+        self.port = serial.Serial(self.tty, 9600)
+        self.port.setDTR() #level=True)
+
+    def run(self):
+        if not self.port:
+            return
+        while True:
+            try:
+                self.wait_for_change()
+                self.check()
+            except Exception:
+                logger.exception("Failed to read the button, trying again in %ds", REOPEN_DELAY)
+                time.sleep(REOPEN_DELAY)
+                self.reopen()
+
+    def reopen(self):
+        if not self.owns_port:
+            return
+        try:
+            self.port.close()
+        except Exception:
+            pass
+        try:
+            self.open()
+        except Exception:
+            # Left for the next failure to try again
+            logger.exception("Failed to reopen %s", self.tty)
+        else:
+            self.wait_in_kernel = True
+            logger.info("Reopened %s", self.tty)
+
+    def wait_for_change(self):
+        if self.wait_in_kernel:
+            try:
+                fcntl.ioctl(self.port.fileno(), termios.TIOCMIWAIT, termios.TIOCM_CD)
+                return
+            except IOError, e:
+                if e.errno == errno.EINTR:
+                    return
+                if e.errno not in (errno.EINVAL, errno.ENOTTY, errno.EIO):
+                    raise
+                logger.info("Can't wait for button changes, polling instead")
+                self.wait_in_kernel = False
+        time.sleep(POLL_INTERVAL)
+
+    def check(self):
+        while True:
             currently_pressed = self.port.getCD()
-            if currently_pressed and not self.pressed:
-                logger.info("Button press detected")
-                self.pressed = True
-                return True
-            elif not currently_pressed:
-                self.pressed = False
-        return False
+            if currently_pressed == self.pressed:
+                return
+            # Only believe it if it's still the same a moment later
+            time.sleep(DEBOUNCE_TIME)
+            if self.port.getCD() == currently_pressed:
+                break
+
+        self.pressed = currently_pressed
+        if currently_pressed:
+            logger.info("Button press detected")
+            self.on_press()
@@ -1,7 +1,8 @@
 
-import piggyphoto
 import pygame
 import StringIO
+import collections
+import contextlib
 import time
 import logging
 
@@ -27,20 +28,53 @@ logger = logging.getLogger('photobooth.cameras')
 
 
 
+@contextlib.contextmanager
+def timed(timings, phase):
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[phase] = timings.get(phase, 0) + time.time() - start
+
+
+def format_timings(timings):
+    return ', '.join('%s %.2fs' % item for item in timings.items())
+
+
 class Camera(object):
-    def __init__(self):
-        self.camera = piggyphoto.Camera()
+    def __init__(self, persistent=False):
+        # When persistent the connection is kept open between shots,
+        # rather than being reopened to get the camera to autofocus
+        self.persistent = persistent
+        # Set between the shots of a burst, which all use one connection
+        self.in_burst = False
+        self.camera = None
+        self.connect()
         self.reset_settings()
 
-        # self.camera.config.main.actions.autofocusdrive=True
         # self.camera.config.main.actions.manualfocusdrive=2
 
-    def try_set_capturesettings(self, setting):
+    def connect(self):
+        # Loading libgphoto2 is slow, so leave it until there's a camera to talk to
+        import piggyphoto
+
+        start = time.time()
+        self.camera = piggyphoto.Camera()
+        # Don't trust what we think the settings are on a new connection
+        self.exposure_mode = None
+        logger.debug("Connected to camera in %.2fs", time.time() - start)
+
+    def try_set_capturesettings(self, setting, autofocus=False):
+        if setting == self.exposure_mode and not autofocus:
+            return
         for x in range(0, 10):
             try:
                 con = self.camera.config
                 con.main.capturesettings.autoexposuremode.value = setting
+                if autofocus:
+                    con.main.actions.autofocusdrive.value = True
                 self.camera.config = con
+                self.exposure_mode = setting
                 if x > 0:
                     logger.info("Set capture settings after %d attempts", x)
                 return
@@ -52,7 +86,7 @@ class Camera(object):
                     time.sleep(x/2)
                 if x > 4 and x % 2 == 1:
                     del self.camera
-                    self.camera = piggyphoto.Camera()
+                    self.connect()
 
     def reset_settings(self):
         self.try_set_capturesettings('AV')
@@ -60,50 +94,92 @@ class Camera(object):
         # self.camera.config.main.capturesettings.aperture.value = DEFAULT_PREVIEW_APERTURE
 
     def set_settings_for_capture(self):
-        self.try_set_capturesettings('Manual')
+        # Reconnecting already makes the camera focus
+        self.try_set_capturesettings('Manual', autofocus=self.persistent)
         # self.camera.config.main.capturesettings.shutterspeed.value = CAPTURE_SHUTTER_SPEED
         # self.camera.config.main.capturesettings.aperture.value = CAPTURE_APERTURE
 
     def capture_preview(self):
+        return pygame.image.load(StringIO.StringIO(self.capture_preview_data()))
+
+    def capture_preview_data(self):
         if not self.camera:
-            self.camera = piggyphoto.Camera()
+            self.connect()
             logger.debug("Created new camera")
         img_file = self.camera.capture_preview()
         image = img_file.get_data()
         img_file.clean()
-        return pygame.image.load(StringIO.StringIO(image))
+        return image
 
-    def capture_image(self, image_path):
+    def capture_image_data(self, more_to_come=False):
+        """
+        Capture straight into memory, returning the JPEG data and the
+        decoded image.
+
+        If more_to_come, the next shot follows straight on, so it keeps the
+        same connection and capture settings.
+        """
+        data = self.capture(self.download_data, more_to_come)
+        return data, pygame.image.load(StringIO.StringIO(data))
+
+    def download_data(self, path):
+        import piggyphoto
+
+        img_file = piggyphoto.cameraFile(self.camera._cam, path.folder, path.name)
+        data = img_file.get_data()
+        img_file.clean()
+        return data
+
+    def capture(self, download, more_to_come=False):
         # Kludge - keep trying to capture the image
         # gphoto throws exceptions if for example the camera can't focus
         for x in range(0, 5):
+            timings = collections.OrderedDict()
             try:
-                if hasattr(self, 'camera'):
-                    # This causes the mirror to close, otherwise
-                    # we don't get autofocus!
-                    self.camera.close()
-                self.camera = piggyphoto.Camera()
-
-                self.set_settings_for_capture()
-                self.camera.capture_image(image_path)
-                self.reset_settings()
-
+                if not (self.persistent or self.in_burst) or x > 0 or not self.camera:
+                    if self.camera:
+                        # This causes the mirror to close, otherwise
+                        # we don't get autofocus!
+                        self.camera.close()
+                    with timed(timings, 'connect'):
+                        self.connect()
+
+                with timed(timings, 'config'):
+                    self.set_settings_for_capture()
+                with timed(timings, 'capture'):
+                    path = self.camera.capture_image()
+                with timed(timings, 'download'):
+                    result = download(path)
+                if not more_to_come:
+                    with timed(timings, 'config'):
+                        self.reset_settings()
+                self.in_burst = more_to_come
+
+                logger.info("Captured image: %s", format_timings(timings))
                 if x > 0:
                     logger.info("Captured image after %d attempts", x)
-                return
+                return result
             except Exception, e:
-                logger.exception("Failed to capture image, attempt %d", x)
+                logger.exception("Failed to capture image, attempt %d (%s)", x,
+                                 format_timings(timings))
                 if x >= 4:
-                    if hasattr(self, 'camera'):
+                    self.in_burst = False
+                    if self.camera:
                         # Release the camera. Hopefully its more likely to work after a restart
                         del self.camera
+                        self.camera = None
                     raise e
                 else:
                     time.sleep(x)
 
+    def wake(self):
+        if not self.camera:
+            self.connect()
+
     def sleep(self):
         del self.camera
         self.camera = None
+        self.in_burst = False
 
 
 class WebcamCamera():
@@ -116,9 +192,10 @@ class WebcamCamera():
     def capture_preview(self):
         return self.camera.get_image()
 
-    def capture_image(self, image_path):
+    def capture_image_data(self, more_to_come=False):
+        # No JPEG to hand - the image gets encoded when it's saved
         time.sleep(0.5)
-        pygame.image.save(self.capture_preview(), image_path)
+        return None, self.capture_preview()
 
     def sleep(self):
         logger.info("Sleep!")
@@ -126,12 +203,18 @@ class WebcamCamera():
 
 class DebugCamera():
     def capture_preview(self):
+        return pygame.image.load(StringIO.StringIO(self.capture_preview_data()))
+
+    def capture_preview_data(self):
         with open('preview.jpg', 'rb') as img:
-            return pygame.image.load(StringIO.StringIO(img.read()))
+            return img.read()
 
-    def capture_image(self, image_path):
+    def capture_image_data(self, more_to_come=False):
         time.sleep(0.5)
-        logger.info("Captured an image: %s", image_path)
+        with open('test.jpg', 'rb') as img:
+            data = img.read()
+        logger.info("Captured an image into memory")
+        return data, pygame.image.load(StringIO.StringIO(data))
 
     def sleep(self):
         logger.info("Sleep!")
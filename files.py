@@ -0,0 +1,29 @@
+import json
+import os
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def load_thumbnail(path, size):
+    """
+    Load an image with PIL, shrunk to fit in size. JPEGs are decoded at a
+    reduced scale, which is much quicker.
+    """
+    image = Image.open(path)
+    image.draft('RGB', size)
+    image = image.convert('RGB')
+    image.thumbnail(size, Image.ANTIALIAS)
+    return image
+
+
+def write_json(path, data):
+    """
+    Replace the file in one go, so it's never left half written.
+    """
+    temp_file = path + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(data, f)
+    os.rename(temp_file, path)
@@ -0,0 +1,181 @@
+import collections
+import json
+import os
+import threading
+import time
+import logging
+
+import pygame
+
+from files import load_thumbnail, write_json
+from montage import save_jpeg
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger('photobooth.gallery')
+
+COMBINED_SUFFIX = '-combined.jpg'
+SLIDE_TIME = 5
+MAX_SURFACES = 3
+THUMBNAIL_QUALITY = 85
+
+
+def fit_size(size, box):
+    """
+    The biggest size with the same shape as size that fits in box.
+    """
+    scale = min(float(box[0]) / size[0], float(box[1]) / size[1])
+    return (int(size[0] * scale), int(size[1] * scale))
+
+
+class Gallery(object):
+    """
+    A slideshow of earlier sessions' combined images.
+
+    Each one gets a screen sized thumbnail in image_dir/thumbnails, listed
+    in an index there, so a big folder is only scanned properly once and
+    after that new sessions are just added. The next slide is loaded in
+    the background while the current one is shown, and only a few decoded
+    slides are kept in memory.
+    """
+    def __init__(self, image_dir, slide_time=SLIDE_TIME, max_surfaces=MAX_SURFACES):
+        self.image_dir = image_dir
+        self.thumbnail_dir = os.path.join(image_dir, 'thumbnails')
+        self.index_file = os.path.join(self.thumbnail_dir, 'index.json')
+        self.slide_time = slide_time
+        self.max_surfaces = max_surfaces
+        self.size = None
+
+        self.lock = threading.Lock()
+        self.names = []
+        self.surfaces = collections.OrderedDict()
+        self.loading = None
+        self.position = -1
+        self.shown_at = 0
+
+    def set_size(self, size):
+        self.size = size
+
+    def start(self):
+        """
+        Bring the index up to date with the folder, in the background.
+        """
+        builder = threading.Thread(target=self.build_index, name='gallery-index')
+        builder.daemon = True
+        builder.start()
+
+    def build_index(self):
+        start = time.time()
+        if not os.path.exists(self.thumbnail_dir):
+            os.makedirs(self.thumbnail_dir)
+        try:
+            with open(self.index_file) as f:
+                indexed = json.load(f)
+        except (IOError, ValueError):
+            indexed = []
+        with self.lock:
+            self.names = indexed + [name for name in self.names if name not in indexed]
+
+        known = set(indexed)
+        new_names = sorted(name for name in os.listdir(self.image_dir)
+                           if name.endswith(COMBINED_SUFFIX) and name not in known)
+        for name in new_names:
+            try:
+                self.make_thumbnail(name)
+            except Exception:
+                logger.exception("Failed to make a thumbnail of %s", name)
+                continue
+            self.added(name)
+        logger.info("Gallery index has %d sessions, %d new, updated in %.1fs",
+                    len(self.names), len(new_names), time.time() - start)
+
+    def make_thumbnail(self, name, image=None):
+        thumbnail_path = os.path.join(self.thumbnail_dir, name)
+        if image is None and Image is not None:
+            image = load_thumbnail(os.path.join(self.image_dir, name), self.size)
+            image.save(thumbnail_path, 'JPEG', quality=THUMBNAIL_QUALITY)
+            return
+        if image is None:
+            image = pygame.image.load(os.path.join(self.image_dir, name))
+        image = pygame.transform.smoothscale(image, fit_size(image.get_size(), self.size))
+        save_jpeg(image, thumbnail_path, THUMBNAIL_QUALITY)
+
+    def add(self, name, image):
+        """
+        Add a new session's combined image, made from the copy in memory.
+        """
+        if not os.path.exists(self.thumbnail_dir):
+            os.makedirs(self.thumbnail_dir)
+        self.make_thumbnail(name, image)
+        self.added(name)
+
+    def added(self, name):
+        with self.lock:
+            if name not in self.names:
+                self.names.append(name)
+            write_json(self.index_file, self.names)
+
+    def current(self):
+        """
+        The name and surface of the slide to show now, or None if there's
+        nothing to show yet. Moves on once the slide has been up long enough
+        and the next one has loaded.
+        """
+        with self.lock:
+            if not self.names:
+                return None
+            if 0 <= self.position < len(self.names):
+                current_name = self.names[self.position]
+            else:
+                current_name = None
+            next_position = (self.position + 1) % len(self.names)
+            next_name = self.names[next_position]
+            next_surface = self.surfaces.get(next_name)
+
+        if current_name is None or time.time() - self.shown_at >= self.slide_time:
+            if next_surface is not None:
+                self.position = next_position
+                self.shown_at = time.time()
+                current_name = next_name
+                with self.lock:
+                    # Keep it from being the next one thrown out
+                    self.surfaces[next_name] = self.surfaces.pop(next_name, next_surface)
+                    next_name = self.names[(next_position + 1) % len(self.names)]
+            if next_name not in self.surfaces:
+                self.preload(next_name)
+
+        if current_name is None:
+            return None
+        with self.lock:
+            surface = self.surfaces.get(current_name)
+        return (current_name, surface) if surface is not None else None
+
+    def preload(self, name):
+        if self.loading:
+            return
+        self.loading = name
+        loader = threading.Thread(target=self.load, args=(name,), name='gallery-load')
+        loader.daemon = True
+        loader.start()
+
+    def load(self, name):
+        try:
+            surface = pygame.image.load(os.path.join(self.thumbnail_dir, name))
+            size = fit_size(surface.get_size(), self.size)
+            if abs(size[0] - surface.get_width()) > 1:
+                # Made for a different screen
+                surface = pygame.transform.smoothscale(surface, size)
+        except Exception:
+            logger.exception("Failed to load the thumbnail of %s", name)
+            with self.lock:
+                self.names.remove(name)
+            self.loading = None
+            return
+        with self.lock:
+            self.surfaces[name] = surface
+            while len(self.surfaces) > self.max_surfaces:
+                self.surfaces.popitem(last=False)
+        self.loading = None
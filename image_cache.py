@@ -0,0 +1,51 @@
+import threading
+import logging
+
+import pygame
+
+logger = logging.getLogger('photobooth.image_cache')
+
+
+class ImageCache(object):
+    """
+    Holds decoded captures, and scaled copies of them, for one session so
+    each file is only read from disk once.
+
+    Shared between the UI and the background composition job, so access
+    is locked.
+    """
+    def __init__(self, loader):
+        self.loader = loader
+        self.images = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, size=None):
+        with self.lock:
+            image = self.images.get((name, size))
+            if image is not None:
+                self.hits += 1
+                return image
+
+            self.misses += 1
+            image = self.get_original(name)
+            if size is not None:
+                image = pygame.transform.scale(image, size)
+                self.images[(name, size)] = image
+            return image
+
+    def get_original(self, name):
+        # Called with the lock already held
+        image = self.images.get((name, None))
+        if image is None:
+            image = self.loader(name)
+            logger.debug("Decoded %s", name)
+            self.images[(name, None)] = image
+        return image
+
+    def put(self, name, image):
+        with self.lock:
+            for key in [key for key in self.images if key[0] == name]:
+                del self.images[key]
+            self.images[(name, None)] = image
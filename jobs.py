@@ -0,0 +1,116 @@
+import Queue
+import collections
+import contextlib
+import threading
+import time
+import logging
+
+logger = logging.getLogger('photobooth.jobs')
+
+
+class Job(object):
+    """
+    A unit of background work. The UI can poll done() each frame rather
+    than blocking on it.
+    """
+    def __init__(self, name, func, args):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+        self.timings = collections.OrderedDict()
+        self.submitted = time.time()
+        self.finished = threading.Event()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = time.time() - start
+
+    def done(self):
+        return self.finished.is_set()
+
+    def succeeded(self):
+        return self.done() and self.error is None
+
+    def wait(self, timeout=None):
+        self.finished.wait(timeout)
+        return self.done()
+
+
+class JobQueue(threading.Thread):
+    """
+    Runs jobs one at a time, in the order they were submitted, on a
+    background thread. Each job's function is called with the job as its
+    first argument so it can time its stages.
+
+    Stage timings are also recorded with the profiler, if given one.
+    """
+    def __init__(self, name='jobs', profiler=None):
+        super(JobQueue, self).__init__(name=name)
+        self.daemon = True
+        self.profiler = profiler
+        self.queue = Queue.Queue()
+        self.current = None
+        self.completed = 0
+        self.failed = 0
+        self.stage_totals = collections.defaultdict(float)
+        self.stage_counts = collections.defaultdict(int)
+
+    def submit(self, name, func, *args):
+        job = Job(name, func, args)
+        self.queue.put(job)
+        logger.debug("Queued job %s, depth now %d", name, self.depth())
+        return job
+
+    def depth(self):
+        return self.queue.qsize() + (1 if self.current else 0)
+
+    def stop(self):
+        """
+        Stop once everything already queued has run.
+        """
+        self.queue.put(None)
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            self.current = job
+            self.run_job(job)
+            self.current = None
+
+    def run_job(self, job):
+        start = time.time()
+        try:
+            job.result = job.func(job, *job.args)
+            self.completed += 1
+        except Exception, e:
+            job.error = e
+            self.failed += 1
+            logger.exception("Job %s failed", job.name)
+        finally:
+            job.timings['total'] = time.time() - start
+            job.timings['queued'] = start - job.submitted
+            for stage, duration in job.timings.items():
+                self.stage_totals[stage] += duration
+                self.stage_counts[stage] += 1
+                if self.profiler:
+                    self.profiler.record(stage, duration, state=self.name)
+            logger.info("Job %s finished: %s", job.name,
+                        ', '.join('%s %.2fs' % item for item in job.timings.items()))
+            job.finished.set()
+
+    def stats(self):
+        return {
+            'depth': self.depth(),
+            'completed': self.completed,
+            'failed': self.failed,
+            'mean_stage_times': dict((stage, self.stage_totals[stage] / self.stage_counts[stage])
+                                     for stage in self.stage_totals),
+        }
@@ -0,0 +1,163 @@
+import math
+import threading
+import logging
+
+import pygame
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger('photobooth.montage')
+
+
+def scale_to_fill(surface, size):
+    """
+    Scale the surface so it covers size, keeping its aspect ratio, then crop
+    the middle out. Equivalent to ImageMagick's
+    -resize WxH^ -gravity center -extent WxH
+    """
+    width, height = surface.get_size()
+    scale = max(float(size[0]) / width, float(size[1]) / height)
+    scaled_size = (max(size[0], int(round(width * scale))),
+                   max(size[1], int(round(height * scale))))
+    if surface.get_bitsize() >= 24:
+        scaled = pygame.transform.smoothscale(surface, scaled_size)
+    else:
+        scaled = pygame.transform.scale(surface, scaled_size)
+
+    crop = pygame.Rect((0, 0), size)
+    crop.center = scaled.get_rect().center
+    return scaled.subsurface(crop).copy()
+
+
+def scale_to_fit(surface, max_size):
+    """
+    Scale the surface down so neither side is longer than max_size,
+    keeping its aspect ratio.
+    """
+    width, height = surface.get_size()
+    scale = float(max_size) / max(width, height)
+    if scale >= 1:
+        return surface
+    return pygame.transform.smoothscale(surface, (int(width * scale), int(height * scale)))
+
+
+def save_jpeg(surface, path, quality):
+    """
+    Save with the given JPEG quality. pygame can't set the quality, so
+    without PIL this falls back to pygame's default.
+    """
+    if Image is None:
+        pygame.image.save(surface, path)
+        return
+    image = Image.frombytes('RGB', surface.get_size(), pygame.image.tostring(surface, 'RGB'))
+    image.save(path, 'JPEG', quality=quality)
+
+
+def grid_layout(size, count, padding=0, aspect=None):
+    """
+    Where each of count images goes in a grid filling size, in reading
+    order. The grid is as near square as it can be, with a short last row
+    centred. Given an aspect ratio, each cell is shrunk to that shape so
+    the images aren't stretched.
+    """
+    columns = int(math.ceil(math.sqrt(count)))
+    rows = int(math.ceil(float(count) / columns))
+    cell_size = ((size[0] - (columns - 1) * padding) / columns,
+                 (size[1] - (rows - 1) * padding) / rows)
+    image_size = cell_size
+    if aspect:
+        image_size = (min(cell_size[0], int(cell_size[1] * aspect)),
+                      min(cell_size[1], int(cell_size[0] / aspect)))
+
+    rects = []
+    for i in range(count):
+        row, column = divmod(i, columns)
+        in_row = min(columns, count - row * columns)
+        cell = pygame.Rect((column + (columns - in_row) / 2.0) * (cell_size[0] + padding),
+                           row * (cell_size[1] + padding), cell_size[0], cell_size[1])
+        rect = pygame.Rect((0, 0), image_size)
+        rect.center = cell.center
+        rects.append(rect)
+    return rects
+
+
+def make_strip(images, size, padding):
+    """
+    Stack the images top to bottom in a white strip, each cropped to the
+    same 3:2 shape and as wide as the strip allows.
+    """
+    strip = pygame.Surface(size, 0, 24)
+    strip.fill((255, 255, 255))
+    cell_width = size[0] - 2 * padding
+    cell_height = min(cell_width * 2 / 3,
+                      (size[1] - (len(images) + 1) * padding) / len(images))
+    x_pos = (size[0] - cell_width) / 2
+    for count, image in enumerate(images):
+        y_pos = padding + count * (cell_height + padding)
+        strip.blit(scale_to_fill(image, (cell_width, cell_height)), (x_pos, y_pos))
+    return strip
+
+
+def make_sheet(strips, size):
+    """
+    Put up to two strips side by side, with a dashed line to cut along. The
+    strips are upright, so a landscape sheet is built portrait then turned.
+    """
+    landscape = size[0] > size[1]
+    width, height = (size[1], size[0]) if landscape else size
+    sheet = pygame.Surface((width, height), 0, 24)
+    sheet.fill((255, 255, 255))
+
+    strip_width = width / 2
+    for count, strip in enumerate(strips):
+        sheet.blit(scale_to_fill(strip, (strip_width, height)), (count * strip_width, 0))
+
+    for y_pos in range(0, height, 40):
+        pygame.draw.line(sheet, (200, 200, 200), (strip_width, y_pos), (strip_width, y_pos + 20))
+
+    if landscape:
+        sheet = pygame.transform.rotate(sheet, 90)
+    return sheet
+
+
+class SheetBatcher(object):
+    """
+    Pairs up strips from consecutive sessions so two get printed on each
+    sheet. A strip still on its own after timeout seconds is printed alone.
+
+    print_sheet is called with the sheet and the name of its first strip.
+    """
+    def __init__(self, size, print_sheet, timeout):
+        self.size = size
+        self.print_sheet = print_sheet
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pending = None
+        self.timer = None
+
+    def add(self, strip, name):
+        with self.lock:
+            if not self.pending:
+                self.pending = (strip, name)
+                self.timer = threading.Timer(self.timeout, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+                return
+            first_strip, first_name = self.pending
+            self.pending = None
+            self.timer.cancel()
+        logger.info("Printing %s and %s on one sheet", first_name, name)
+        self.print_sheet(make_sheet([first_strip, strip], self.size), first_name)
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            strip, name = self.pending
+            self.pending = None
+            self.timer.cancel()
+        logger.info("Printing %s on its own", name)
+        self.print_sheet(make_sheet([strip], self.size), name)
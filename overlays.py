@@ -0,0 +1,154 @@
+import json
+import logging
+
+import pygame
+
+from text_renderer import TEXT_COLOUR
+
+logger = logging.getLogger('photobooth.overlays')
+
+# Each overlay is drawn once, when the screen size is known, then just
+# blitted. anchor is any pygame.Rect position attribute, matched up with
+# the same point on the screen. Overlays with a list of screens are extras
+# (logos and the like) drawn automatically on those screens.
+DEFAULT_THEME = {
+    'idle': {
+        'type': 'text',
+        'lines': ['Press the button to start!'],
+        'size': 142,
+        'background': (0, 0, 0),
+    },
+    # Over the slideshow of earlier sessions, when there's one to show
+    'gallery': {
+        'type': 'text',
+        'lines': ['Press the button to start!'],
+        'size': 100,
+        'anchor': 'midbottom',
+        'offset_lines': (0, -0.5),
+    },
+    'ready': {
+        'type': 'text',
+        'lines': ['Push when ready!'],
+        'size': 142,
+    },
+    'arrow': {
+        'type': 'polygon',
+        'size': (300, 300),
+        'points': ((100, 300), (200, 300), (200, 100), (300, 100),
+                   (150, 0), (0, 100), (100, 100)),
+        'colour': (255, 255, 255),
+        'anchor': 'midtop',
+        'offset': (0, 20),
+    },
+    'printing': {
+        'type': 'text',
+        'lines': ['Printing...'],
+        'size': 100,
+        'anchor': 'midbottom',
+        'offset_lines': (0, -1.5),
+    },
+    'waking': {
+        'type': 'text',
+        'lines': ['Waking up the camera...'],
+        'size': 100,
+        'anchor': 'midbottom',
+        'offset_lines': (0, -1.5),
+    },
+    'check_printer': {
+        'type': 'text',
+        'lines': ['Check printer!'],
+        'size': 100,
+        'anchor': 'midbottom',
+        'offset_lines': (0, -1.5),
+    },
+}
+
+
+def load_theme(path=None):
+    """
+    The default theme, with anything in the JSON file at path added to or
+    replacing it.
+    """
+    theme = dict(DEFAULT_THEME)
+    if path:
+        with open(path) as f:
+            theme.update(json.load(f))
+        logger.info("Loaded theme from %s", path)
+    return theme
+
+
+class Overlays(object):
+    def __init__(self, theme=None):
+        self.theme = theme or DEFAULT_THEME
+        self.overlays = {}
+        self.extras = {}
+
+    def build(self, screen_size, text):
+        screen = pygame.Rect((0, 0), screen_size)
+        for name, spec in self.theme.items():
+            try:
+                surface = self.build_surface(spec, screen_size, text)
+            except Exception:
+                logger.exception("Failed to build overlay %s", name)
+                continue
+            rect = surface.get_rect()
+            anchor = spec.get('anchor', 'center')
+            setattr(rect, anchor, getattr(screen, anchor))
+            offset = spec.get('offset', (0, 0))
+            if 'offset_lines' in spec:
+                line_height = text.line_height(spec['size'])
+                offset = [int(lines * line_height) for lines in spec['offset_lines']]
+            rect.move_ip(offset)
+
+            self.overlays[name] = (surface, rect.topleft)
+            for screen_name in spec.get('screens', []):
+                self.extras.setdefault(screen_name, []).append(name)
+        logger.debug("Built %d overlays", len(self.overlays))
+
+    def build_surface(self, spec, screen_size, text):
+        kind = spec['type']
+        if kind == 'text':
+            return self.build_text(spec, screen_size, text)
+        elif kind == 'polygon':
+            surface = pygame.Surface(spec['size'], flags=pygame.SRCALPHA)
+            pygame.draw.polygon(surface, spec['colour'], spec['points'])
+            return surface
+        elif kind == 'image':
+            surface = pygame.image.load(spec['path']).convert_alpha()
+            if 'width' in spec:
+                # Fraction of the screen width
+                width = int(spec['width'] * screen_size[0])
+                height = surface.get_height() * width / surface.get_width()
+                surface = pygame.transform.smoothscale(surface, (width, height))
+            return surface
+        else:
+            raise ValueError("Unknown overlay type: " + kind)
+
+    def build_text(self, spec, screen_size, text):
+        size = spec['size']
+        colour = tuple(spec.get('colour', TEXT_COLOUR))
+        lines = [text.render(line, size, colour) for line in spec['lines']]
+        line_height = text.line_height(size)
+
+        if 'background' in spec:
+            surface = pygame.Surface(screen_size)
+            surface.fill(spec['background'])
+        else:
+            width = max(line.get_width() for line in lines)
+            surface = pygame.Surface((width, line_height * len(lines)), flags=pygame.SRCALPHA)
+
+        area = surface.get_rect()
+        middle_line = len(lines) / 2.0 - 0.5
+        for i, line in enumerate(lines):
+            line_pos = line.get_rect()
+            line_pos.centerx = area.centerx
+            line_pos.centery = area.centery + (i - middle_line) * line_height
+            surface.blit(line, line_pos)
+        return surface
+
+    def get(self, name):
+        return self.overlays[name]
+
+    def extras_for(self, screen_name):
+        return [self.overlays[name] for name in self.extras.get(screen_name, [])
+                if name in self.overlays]
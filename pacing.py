@@ -0,0 +1,89 @@
+import collections
+import time
+import logging
+
+import pygame
+
+from button import BUTTON_EVENT
+
+logger = logging.getLogger('photobooth.pacing')
+
+ACTIVE_FPS = 25
+IDLE_INTERVAL = 1.0
+IDLE_TIMER_EVENT = pygame.USEREVENT + 2
+WAKE_EVENTS = (pygame.KEYUP, pygame.QUIT, BUTTON_EVENT)
+FRAME_SAMPLES = 500
+REPORT_INTERVAL = 60
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class FramePacer(object):
+    """
+    Decides how long to wait between frames. While active it runs at a
+    fixed frame rate. While idle it sleeps until a key or button press, or
+    until idle_interval has passed, so a static screen costs next to
+    nothing.
+
+    Keeps the time spent working on each frame, so we can see how close
+    to the frame budget we are.
+    """
+    def __init__(self, active_fps=ACTIVE_FPS, idle_interval=IDLE_INTERVAL):
+        self.active_fps = active_fps
+        self.idle_interval = idle_interval
+        self.clock = pygame.time.Clock()
+        self.idle = False
+        self.frame_started = None
+        self.work_times = collections.deque(maxlen=FRAME_SAMPLES)
+        self.last_report = time.time()
+
+    def set_idle(self, idle):
+        if idle == self.idle:
+            return
+        self.idle = idle
+        interval = int(self.idle_interval * 1000) if idle else 0
+        pygame.time.set_timer(IDLE_TIMER_EVENT, interval)
+
+    def wait(self):
+        if self.frame_started is not None and not self.idle:
+            self.work_times.append(time.time() - self.frame_started)
+
+        if self.idle:
+            self.sleep_until_woken()
+            self.clock.tick()
+        else:
+            self.clock.tick(self.active_fps)
+
+        self.frame_started = time.time()
+        if self.frame_started - self.last_report >= REPORT_INTERVAL:
+            self.last_report = self.frame_started
+            if self.work_times:
+                logger.debug("Frame times: %s", self.stats())
+
+    def sleep_until_woken(self):
+        while True:
+            event = pygame.event.wait()
+            if event.type in WAKE_EVENTS:
+                # Leave it for the main loop to handle
+                pygame.event.post(event)
+                return
+            if event.type == IDLE_TIMER_EVENT:
+                return
+
+    def stats(self):
+        """
+        Work time per active frame, in milliseconds.
+        """
+        times = list(self.work_times)
+        if not times:
+            return {}
+        return {
+            'p50': percentile(times, 0.5) * 1000,
+            'p90': percentile(times, 0.9) * 1000,
+            'p99': percentile(times, 0.99) * 1000,
+            'max': max(times) * 1000,
+            'fps': self.clock.get_fps(),
+        }
@@ -5,13 +5,23 @@ import os
 import sys
 import time
 import datetime
-from subprocess import call
 import argparse
 import logging
 
 from cameras import DebugCamera, WebcamCamera, Camera
-from button import Button
-from printer import CmdPrinter, PyPrinter, FilePrinter
+from button import Button, BUTTON_EVENT
+from printer import CmdPrinter, PyPrinter, FilePrinter, STATUS_POLL_INTERVAL
+from preview import PreviewPipeline
+from text_renderer import TextRenderer
+from jobs import JobQueue
+from montage import scale_to_fill, scale_to_fit, save_jpeg, make_strip, grid_layout, SheetBatcher
+from image_cache import ImageCache
+from overlays import Overlays, load_theme
+from pacing import FramePacer
+from profiling import Profiler
+from startup import Startup
+from animation import AnimationMaker
+from gallery import Gallery, SLIDE_TIME
 
 logger = logging.getLogger('photobooth')
 
@@ -26,19 +36,45 @@ logger.addHandler(stdout_log_handler)
 
 logger.setLevel(logging.DEBUG)
 
-try:
-    from upload import upload_image_async
-except ImportError:
-    upload_image_async = None
 
 PADDING_PERCENT = 1.5
-PRINT_IMAGE_SIZE = "2136x1424"
+PRINT_IMAGE_SIZE = (2136, 1424)
+# When batching, print strips are half the sheet
+STRIP_SIZE = (PRINT_IMAGE_SIZE[1] / 2, PRINT_IMAGE_SIZE[0])
+BATCH_TIMEOUT = 60
+WEB_IMAGE_MAX_SIZE = 1600
+WEB_IMAGE_QUALITY = 80
+# Tell people how long their print will be once it's longer than this
+LONG_PRINT_WAIT = 90
+# How far back the profile overlay looks
+PROFILE_WINDOW = 5
+# How long the camera is kept awake after a key press, if no session starts
+CAMERA_WARM_TIME = 60
+SHOT_COUNT = 4
+BURST_INTERVAL = 1.0
 
 
 class PhotoBooth(object):
-    def __init__(self, image_dest, fullscreen, debug, camera, printer, upload_to):
+    def __init__(self, image_dest, fullscreen, debug, camera, printer, upload_to,
+                 dirty_rects=False, theme=None, upload_originals=False,
+                 web_max_size=WEB_IMAGE_MAX_SIZE, web_quality=WEB_IMAGE_QUALITY,
+                 batch_prints=False, profile_path=None, startup=None,
+                 shot_count=SHOT_COUNT, shot_countdown=None, burst=False,
+                 burst_interval=BURST_INTERVAL, animation=None, gallery=False,
+                 slide_time=SLIDE_TIME):
         self.debug = debug
+        # The camera and printer may still be starting up, in which case
+        # they're None until startup has them ready
+        self.startup = startup or Startup()
         self.camera = camera
+        self.profiler = Profiler(profile_path)
+        self.show_profile = False
+        self.preview = PreviewPipeline(camera, profiler=self.profiler)
+        self.preview_wanted = False
+        self.text = TextRenderer()
+        self.overlays = Overlays(theme)
+        self.jobs = JobQueue(profiler=self.profiler)
+        self.writer = JobQueue('writer', profiler=self.profiler)
         if self.debug:
             self.count_down_time = 2
             self.image_display_time = 2
@@ -51,87 +87,326 @@ class PhotoBooth(object):
             self.montage_display_time = 15
             self.idle_time = 240
 
+        self.shot_count = shot_count
+        # The first countdown is the full count_down_time, the rest can be shorter
+        self.shot_countdown = shot_countdown
+        # In burst mode only the first shot has a countdown, the rest follow
+        # burst_interval apart on the same camera connection
+        self.burst = burst
+        self.burst_interval = burst_interval
+
         self.printer = printer
         self.upload_to = upload_to
+        if upload_to:
+            # Only needs requests when uploading
+            from upload import UploadQueue
+            self.uploader = UploadQueue(upload_to, os.path.join(image_dest, 'upload_queue.json'))
+        else:
+            self.uploader = None
+        self.upload_originals = upload_originals
+        self.web_max_size = web_max_size
+        self.web_quality = web_quality
+        if animation:
+            self.animator = AnimationMaker(animation, self.animation_done)
+        else:
+            self.animator = None
+        if gallery:
+            self.gallery = Gallery(image_dest, slide_time)
+        else:
+            self.gallery = None
+        if batch_prints:
+            self.batcher = SheetBatcher(PRINT_IMAGE_SIZE, self.print_sheet, BATCH_TIMEOUT)
+        else:
+            self.batcher = None
         self.output_dir = image_dest
         self.size = None
         self.fullscreen = fullscreen
         self.events = []
         self.current_session = None
+        self.camera_warmed = None
+
+        # When set, only the areas of the screen that changed are pushed
+        # to the display, and frames where nothing changed are skipped
+        self.dirty_rects_mode = dirty_rects
+        self.dirty_rects = []
+        self.previous_dirty_rects = []
+        self.full_redraw = True
+        self.screen_content = None
+        self.skipped_frames = 0
+
+    def mark_dirty(self, rect=None):
+        """
+        Record that part of the screen changed - or all of it if no rect is given.
+        """
+        self.screen_content = None
+        if rect is None:
+            self.full_redraw = True
+        else:
+            self.dirty_rects.append(rect)
+
+    def update_display(self):
+        with self.profiler.phase('flip'):
+            if not self.dirty_rects_mode or self.full_redraw:
+                pygame.display.flip()
+            elif self.dirty_rects:
+                # Whatever was drawn last frame has been painted over, so needs
+                # pushing again as well
+                pygame.display.update(self.dirty_rects + self.previous_dirty_rects)
+            else:
+                self.skipped_frames += 1
+        self.previous_dirty_rects = self.dirty_rects
+        self.dirty_rects = []
+        self.full_redraw = False
 
-    def capture_preview(self):
-        picture = self.camera.capture_preview()
-
-        if self.size:
-            picture = pygame.transform.scale(picture, self.size)
-        picture = pygame.transform.flip(picture, True, False)
-        return picture
+    def clear_screen(self):
+        self.main_surface.fill((0, 0, 0))
+        self.mark_dirty()
 
     def display_preview(self):
-        picture = self.capture_preview()
-        self.main_surface.blit(picture, (0, 0))
+        self.preview_wanted = True
+        self.preview.resume()
+        self.screen_content = None
+        new_frame = self.preview.fresh
+        picture = self.preview.latest()
+        if picture:
+            # Until the camera wakes this is the last frame from before it slept
+            self.main_surface.blit(picture, (0, 0))
+            if new_frame:
+                self.mark_dirty()
+        else:
+            self.clear_screen()
+        if self.preview.waking():
+            self.display_overlay('waking')
+        self.display_extras('preview')
+        if self.debug:
+            self.display_preview_stats()
+
+    def display_preview_stats(self):
+        stats = self.preview.stats()
+        font = self.text.get_font(30)
+        line = font.render("Preview %.1f fps, %d dropped" % (stats['fps'], stats['dropped']),
+                           1, (255, 255, 0))
+        self.mark_dirty(self.main_surface.blit(line, (10, 10)))
+
+    def display_profile(self):
+        """
+        Show the mean and worst time of each phase over the last few
+        seconds, for each state it happened in.
+        """
+        summary = self.profiler.summary(PROFILE_WINDOW)
+        font = self.text.get_font(24)
+        lines = [font.render("%s %s: %d x %.1fms, max %.1fms" %
+                             (state, phase, times['count'], times['mean'], times['max']),
+                             1, (255, 255, 0))
+                 for (state, phase), times in sorted(summary.items())]
+        if not lines:
+            return
+        line_height = font.get_linesize()
+        box = pygame.Rect(10, 50, max(line.get_width() for line in lines),
+                          line_height * len(lines))
+        self.main_surface.fill((0, 0, 0), box)
+        for i, line in enumerate(lines):
+            self.main_surface.blit(line, (box.x, box.y + i * line_height))
+        self.mark_dirty(box)
 
     def display_image(self, image_name):
-        picture = self.load_image(image_name)
-        picture = pygame.transform.scale(picture, self.size)
+        if self.dirty_rects_mode and self.screen_content == ('image', image_name):
+            return
+        picture = self.load_image(image_name, self.size)
         self.main_surface.blit(picture, (0, 0))
+        self.mark_dirty()
+        self.screen_content = ('image', image_name)
 
     def start(self):
+        if self.animator:
+            self.animator.start()
         pygame.init()
         pygame.mouse.set_visible(False)
 
-        self.clock = pygame.time.Clock()
+        self.pacer = FramePacer()
+
+        self.setup_display()
+        self.startup.mark('display')
+        # Get something on the screen before anything slow happens
+        self.wait()
+        self.update_display()
+        self.startup.mark('first frame')
+
+        self.startup.add('button', self.add_button_listener)
+        self.start_workers()
 
-        self.add_button_listener()
+        try:
+            while self.main_loop():
+                pass
+        finally:
+            self.shutdown()
+
+    def setup_display(self):
+        self.open_display()
+        self.main_surface = pygame.display.get_surface()
+
+        self.size = self.main_surface.get_size()
 
+        self.overlays.build(self.size, self.text)
+        self.preview.set_size(self.size)
+        if self.gallery:
+            self.gallery.set_size(self.size)
+
+    def open_display(self):
         if self.fullscreen:
             pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
         else:
             info = pygame.display.Info()
             pygame.display.set_mode((info.current_w/2, info.current_h/2))
 
-        self.main_surface = pygame.display.get_surface()
+    def start_workers(self):
+        if self.gallery:
+            self.gallery.start()
+        self.preview.start()
+        self.jobs.start()
+        self.writer.start()
+        if self.uploader:
+            self.uploader.start()
+
+    def shutdown(self):
+        self.profiler.dump()
+        self.preview.stop()
+        self.sleep_camera()
+        logger.info("Waiting for %d background jobs", self.jobs.depth())
+        self.jobs.stop()
+        self.writer.stop()
+        self.jobs.join()
+        self.writer.join()
+        if self.animator:
+            logger.info("Waiting for %d animations", self.animator.stats()['pending'])
+            self.animator.stop()
+        if self.batcher:
+            self.batcher.flush()
+        if self.printer:
+            # Hands anything still queued to the printer, or keeps it for the next start
+            self.printer.stop()
+        if self.uploader:
+            # Anything left is picked up again on the next start
+            self.uploader.stop()
+
+    def check_startup(self):
+        self.startup.check()
+        if self.camera is None and self.startup.ready('camera'):
+            self.camera = self.startup.result('camera')
+            self.preview.camera = self.camera
+        if self.printer is None and self.startup.ready('printer'):
+            self.printer = self.startup.result('printer')
+        self.startup.log_when_done()
+
+    def wake_camera(self):
+        if self.camera is not None:
+            self.preview.wake()
+
+    def sleep_camera(self):
+        if self.camera is None:
+            return
+        self.preview.sleep()
 
-        self.size = self.main_surface.get_size()
+    def main_loop(self):
+        self.pacer.wait()
 
-        while self.main_loop():
-            pass
-        self.camera.sleep()
+        # Only what happened since the last frame counts. Button presses
+        # are posted from the button thread, so are never missed.
+        self.events = [event for event in pygame.event.get()
+                       if event.type in (pygame.KEYUP, pygame.QUIT, BUTTON_EVENT)]
 
-    def main_loop(self):
-        pygame.event.clear()
-        self.clock.tick(25)
-        if len(self.events) > 10:
-            self.events = self.events[:10]
-        pygame.display.flip()
+        self.check_startup()
 
-        button_press = self.space_pressed() or self.button.is_pressed()
+        button_press = self.space_pressed() or self.button_pressed()
+        if self.check_key_event(pygame.K_F1):
+            self.show_profile = not self.show_profile
+            self.mark_dirty()
 
+        frame_start = time.time()
+        self.preview_wanted = False
         if self.current_session:
             self.current_session.do_frame(button_press)
             if self.current_session.idle():
                 self.current_session = None
-                self.camera.sleep()
+                self.sleep_camera()
+                logger.debug("Text cache: %s", self.text.stats())
             elif self.current_session.finished():
                 # Start a new session
                 self.current_session = PhotoSession(self)
-        elif button_press:
-            # Start a new session
+                logger.debug("Text cache: %s", self.text.stats())
+                if self.animator:
+                    logger.debug("Animations: %s", self.animator.stats())
+                if self.uploader:
+                    logger.debug("Upload queue: %s", self.uploader.stats())
+        elif button_press and self.camera:
+            # Start a new session, connecting to the camera while it gets going
+            self.wake_camera()
+            self.camera_warmed = None
             self.current_session = PhotoSession(self)
         else:
-            self.wait()
+            if button_press:
+                logger.info("Camera isn't ready yet, ignoring button press")
+            self.warm_camera()
+            self.profiler.state = 'Idle'
+            with self.profiler.phase('draw'):
+                self.wait()
+
+        if not self.preview_wanted:
+            self.preview.pause()
+
+        if self.show_profile:
+            self.display_profile()
+        self.update_display()
+        self.profiler.record('frame', time.time() - frame_start)
+        self.profiler.maybe_dump()
+        # Nothing moves on the idle screen, so once it's shown only wake up for presses
+        self.pacer.set_idle(self.current_session is None and
+                            self.screen_content is not None and self.screen_content[0] == 'idle')
 
         return self.check_for_quit_event()
 
+    def warm_camera(self):
+        """
+        Any key wakes the camera up ready for a session, but it goes back to
+        sleep if one doesn't start soon.
+        """
+        if any(event.type == pygame.KEYUP for event in self.events):
+            self.wake_camera()
+            self.camera_warmed = time.time()
+        elif self.camera_warmed and time.time() - self.camera_warmed > CAMERA_WARM_TIME:
+            self.camera_warmed = None
+            self.sleep_camera()
+
     def wait(self):
-        self.main_surface.fill((0, 0, 0))
-        self.render_text_centred('Press the button to start!')
+        slide = self.gallery.current() if self.gallery else None
+        content = ('idle', slide[0] if slide else None)
+        if self.dirty_rects_mode and self.screen_content == content:
+            return
+        if slide:
+            name, picture = slide
+            self.main_surface.fill((0, 0, 0))
+            position = picture.get_rect(center=self.main_surface.get_rect().center)
+            self.main_surface.blit(picture, position)
+            self.mark_dirty()
+            self.display_overlay('gallery')
+        else:
+            self.display_overlay('idle')
+        self.display_extras('idle')
+        self.screen_content = content
+
+    def display_overlay(self, name):
+        overlay, position = self.overlays.get(name)
+        self.mark_dirty(self.main_surface.blit(overlay, position))
+
+    def display_extras(self, screen_name):
+        for overlay, position in self.overlays.extras_for(screen_name):
+            self.mark_dirty(self.main_surface.blit(overlay, position))
 
     def render_text_centred(self, *text_lines):
         location = self.main_surface.get_rect()
-        font = pygame.font.SysFont(pygame.font.get_default_font(), 142)
-        rendered_lines = [font.render(text, 1, (210, 210, 210)) for text in text_lines]
-        line_height = font.get_linesize()
+        with self.profiler.phase('text'):
+            rendered_lines = [self.text.render(text, 142) for text in text_lines]
+        line_height = self.text.line_height(142)
         middle_line = len(text_lines) / 2.0 - 0.5
 
         for i, line in enumerate(rendered_lines):
@@ -139,103 +414,187 @@ class PhotoBooth(object):
             lines_to_shift = i - middle_line
             line_pos.centerx = location.centerx
             line_pos.centery = location.centery + lines_to_shift * line_height
-            self.main_surface.blit(line, line_pos)
+            self.mark_dirty(self.main_surface.blit(line, line_pos))
 
     def render_text_bottom(self, text, size=142):
         location = self.main_surface.get_rect()
-        font = pygame.font.SysFont(pygame.font.get_default_font(), size)
-        line = font.render(text, 1, (210, 210, 210))
-        line_height = font.get_linesize()
+        with self.profiler.phase('text'):
+            line = self.text.render(text, size)
+        line_height = self.text.line_height(size)
 
         line_pos = line.get_rect()
         line_pos.centerx = location.centerx
         line_pos.centery = location.height - 2 * line_height
-        self.main_surface.blit(line, line_pos)
+        self.mark_dirty(self.main_surface.blit(line, line_pos))
 
-    def capture_image(self, file_name):
+    def capture_image(self, file_name, more_to_come=False):
         file_path = os.path.join(self.output_dir, file_name)
         logger.info("Capturing image to: %s", file_path)
-        self.camera.capture_image(file_path)
+        with self.preview.camera_lock, self.profiler.phase('capture'):
+            data, image = self.camera.capture_image_data(more_to_come)
+        # The session reads it from memory, so the file can be written later
+        self.current_session.images.put(file_name, image)
+        if not self.debug:
+            self.writer.submit(file_name, self.write_capture, file_path, data, image)
+
+    def write_capture(self, job, file_path, data, image):
+        if data:
+            with open(file_path, 'wb') as f:
+                f.write(data)
+        else:
+            pygame.image.save(image, file_path)
+        logger.debug("Wrote capture to: %s", file_path)
 
     def display_camera_arrow(self, clear_screen=False):
         if clear_screen:
-            self.main_surface.fill((0, 0, 0))
-        arrow = pygame.Surface((300, 300), flags=pygame.SRCALPHA)
-        pygame.draw.polygon(arrow, (255, 255, 255),
-                            ((100, 0), (200, 0), (200, 200),
-                             (300, 200), (150, 300), (0, 200), (100, 200)))
-        # TODO: Update the coordinates above instead of this
-        arrow = pygame.transform.flip(arrow, False, True)
-        x = (self.size[0] - 300) / 2
-        self.main_surface.blit(arrow, (x, 20))
-
-    def load_image(self, file_name):
-        if self.debug:
-            image_path = "test.jpg"
-        else:
-            image_path = os.path.join(self.output_dir, file_name)
-        return pygame.image.load(image_path)
+            self.clear_screen()
+        self.display_overlay('arrow')
 
-    def save_and_print_combined(self, out_name, images):
-        logger.info("Saving image: %s", out_name)
-        out_path = os.path.join(self.output_dir, out_name)
-        first_size = self.load_image(images[0]).get_size()
-        padding_pxls = int(PADDING_PERCENT / 100.0 * first_size[0])
-        logger.debug("Padding: %s", padding_pxls)
+    def image_path(self, file_name):
+        if self.debug:
+            return "test.jpg"
+        return os.path.join(self.output_dir, file_name)
 
-        size = ((first_size[0] - padding_pxls)/2, (first_size[1] - padding_pxls)/2)
-        logger.debug("Image size: %s", size)
+    def read_image(self, file_name):
+        return pygame.image.load(self.image_path(file_name))
 
-        combined = pygame.Surface(first_size)
-        combined.fill((255, 255, 255))
-        for count, image_name in enumerate(images):
-            image = self.load_image(image_name)
+    def load_image(self, file_name, size=None):
+        """
+        Load a capture, scaled to size if given. Captures from the current
+        session come from its cache.
+        """
+        if self.current_session:
+            return self.current_session.images.get(file_name, size)
+        image = self.read_image(file_name)
+        if size:
             image = pygame.transform.scale(image, size)
-            x_pos = (size[0] + padding_pxls) * (count % 2)
-            y_pos = (size[1] + padding_pxls) * (1 if count > 1 else 0)
-            combined.blit(image, (x_pos, y_pos))
+        return image
 
-        logger.info("Save image to: %s", out_path)
-        if not self.debug:
-            pygame.image.save(combined, out_path)
+    def save_and_print_combined_async(self, out_name, images, image_cache):
+        """
+        Queue up the combined image to be built, printed and uploaded in the
+        background. Returns the job, which can be polled with done().
+        """
+        return self.jobs.submit(out_name, self.save_and_print_combined,
+                                out_name, images, image_cache)
 
-        if self.upload_to:
-            upload_image_async(self.upload_to, out_path)
+    def save_and_print_combined(self, job, out_name, images, image_cache):
+        logger.info("Saving image: %s", out_name)
+        out_path = os.path.join(self.output_dir, out_name)
 
-        if self.printer:
+        with job.stage('compose'):
+            first_size = image_cache.get(images[0]).get_size()
+            padding_pxls = int(PADDING_PERCENT / 100.0 * first_size[0])
+            logger.debug("Padding: %s", padding_pxls)
+
+            aspect = float(first_size[0]) / first_size[1]
+            cells = grid_layout(first_size, len(images), padding_pxls, aspect)
+            logger.debug("Image size: %s", cells[0].size)
+
+            combined = pygame.Surface(first_size, 0, 24)
+            combined.fill((255, 255, 255))
+            for image_name, cell in zip(images, cells):
+                combined.blit(image_cache.get(image_name, cell.size), cell)
+
+        with job.stage('save'):
+            logger.info("Save image to: %s", out_path)
+            if not self.debug:
+                pygame.image.save(combined, out_path)
+
+        if self.gallery and not self.debug:
+            with job.stage('gallery'):
+                self.gallery.add(out_name, combined)
+
+        if self.uploader:
+            with job.stage('web'):
+                web_path = self.save_for_web(combined, out_name)
+            with job.stage('upload'):
+                # The small copy goes first, originals only when there's nothing else to send
+                self.uploader.add(web_path)
+                if self.upload_originals:
+                    self.uploader.add(out_path, priority=1)
+
+        if self.printer and self.batcher:
+            with job.stage('print_resize'):
+                padding = int(PADDING_PERCENT / 100.0 * STRIP_SIZE[0])
+                strip = make_strip([image_cache.get(name) for name in images], STRIP_SIZE, padding)
+            with job.stage('print'):
+                self.batcher.add(strip, out_name)
+        elif self.printer:
             if PRINT_IMAGE_SIZE:
-                print_dir = os.path.join(self.output_dir, 'to_print')
-                print_path = os.path.join(print_dir, out_name)
-                convert_cmd = ['convert', out_path, '-resize',
-                               PRINT_IMAGE_SIZE + '^', '-gravity', 'center',
-                               '-extent', PRINT_IMAGE_SIZE, print_path]
-
-                logger.info(' '.join(convert_cmd))
-                if not self.debug:
-                    if not os.path.exists(print_dir):
-                        os.makedirs(print_dir)
-                    call(convert_cmd)
+                with job.stage('print_resize'):
+                    print_path = self.save_for_print(combined, out_name)
             else:
                 print_path = out_path
-            self.printer.print_image(print_path)
+            with job.stage('print'):
+                self.printer.print_image(print_path)
+
+    def make_animation_async(self, out_name, images):
+        """
+        Queued behind the captures' writes, so they're all on disk by the
+        time the animation is made from them.
+        """
+        out_name = os.path.splitext(out_name)[0] + '.' + self.animator.format
+        return self.writer.submit(out_name, self.make_animation, out_name, images)
+
+    def make_animation(self, job, out_name, images):
+        with job.stage('animation'):
+            self.animator.submit([self.image_path(name) for name in images],
+                                 os.path.join(self.output_dir, 'animations', out_name))
+
+    def animation_done(self, path):
+        if self.uploader:
+            self.uploader.add(path)
+
+    def save_for_web(self, combined, out_name):
+        web_dir = os.path.join(self.output_dir, 'web')
+        web_path = os.path.join(web_dir, out_name)
+        web_image = scale_to_fit(combined, self.web_max_size)
+
+        logger.info("Save web image to: %s", web_path)
+        if not self.debug:
+            if not os.path.exists(web_dir):
+                os.makedirs(web_dir)
+            save_jpeg(web_image, web_path, self.web_quality)
+        return web_path
+
+    def save_for_print(self, combined, out_name):
+        """
+        Crop the combined image to the print size straight from memory,
+        rather than reading back the saved copy.
+        """
+        return self.save_print_image(scale_to_fill(combined, PRINT_IMAGE_SIZE), out_name)
+
+    def print_sheet(self, sheet, out_name):
+        self.printer.print_image(self.save_print_image(sheet, out_name))
+
+    def save_print_image(self, print_image, out_name):
+        print_dir = os.path.join(self.output_dir, 'to_print')
+        print_path = os.path.join(print_dir, out_name)
+
+        logger.info("Save print image to: %s", print_path)
+        if not self.debug:
+            if not os.path.exists(print_dir):
+                os.makedirs(print_dir)
+            pygame.image.save(print_image, print_path)
+        return print_path
 
     def add_button_listener(self):
         self.button = Button()
+        self.button.start()
 
     def check_key_event(self, *keys):
-        self.events += pygame.event.get(pygame.KEYUP)
-        for event in self.events:
-            if event.dict['key'] in keys:
-                self.events = []
-                return True
-        return False
+        return any(event.type == pygame.KEYUP and event.key in keys for event in self.events)
 
     def space_pressed(self):
         return self.check_key_event(pygame.K_SPACE)
 
+    def button_pressed(self):
+        return any(event.type == BUTTON_EVENT for event in self.events)
+
     def check_for_quit_event(self):
         return not self.check_key_event(pygame.K_q, pygame.K_ESCAPE) \
-            and not pygame.event.peek(pygame.QUIT)
+            and not any(event.type == pygame.QUIT for event in self.events)
 
 
 class SessionState(object):
@@ -261,7 +620,7 @@ class TimedState(SessionState):
 class WaitingState(SessionState):
     def run(self):
         self.session.booth.display_preview()
-        self.session.booth.render_text_centred("Push when ready!")
+        self.session.booth.display_overlay('ready')
 
     def next(self, button_pressed):
         if button_pressed:
@@ -273,7 +632,12 @@ class WaitingState(SessionState):
 
 class CountdownState(TimedState):
     def __init__(self, session):
-        super(CountdownState, self).__init__(session, session.booth.count_down_time)
+        booth = session.booth
+        if session.photo_count and booth.shot_countdown is not None:
+            countdown = booth.shot_countdown
+        else:
+            countdown = booth.count_down_time
+        super(CountdownState, self).__init__(session, countdown)
         self.capture_start = datetime.datetime.now()
 
     def run(self):
@@ -286,8 +650,9 @@ class CountdownState(TimedState):
         if time_remaining <= 0:
             self.session.booth.display_camera_arrow(clear_screen=True)
         else:
-            lines = [u'Taking picture %d of 4 in:' %
-                     (self.session.photo_count + 1), str(int(time_remaining))]
+            lines = [u'Taking picture %d of %d in:' %
+                     (self.session.photo_count + 1, self.session.booth.shot_count),
+                     str(int(time_remaining))]
             if time_remaining < 2.5 and int(time_remaining * 2) % 2 == 0:
                 lines = ["Look at the camera!", ""] + lines
             elif time_remaining < 2.5:
@@ -299,16 +664,41 @@ class CountdownState(TimedState):
 
     def next(self, button_pressed):
         if self.time_up():
-            image = self.take_picture()
+            image = self.session.take_picture()
+            if self.session.bursting():
+                return BurstState(self.session, image)
             return ShowLastCaptureState(self.session, image)
         else:
             return self
 
-    def take_picture(self):
-        self.session.photo_count += 1
-        image_name = self.session.get_image_name(self.session.photo_count)
-        self.session.booth.capture_image(image_name)
-        return image_name
+
+class BurstState(TimedState):
+    """
+    Shows the last capture while the next one in a burst is taken.
+    """
+    def __init__(self, session, image):
+        super(BurstState, self).__init__(session, session.booth.burst_interval)
+        self.image = image
+
+    def run(self):
+        booth = self.session.booth
+        # The caption counts as part of the picture, so neither is redrawn every frame
+        content = ('burst', self.image)
+        if booth.dirty_rects_mode and booth.screen_content == content:
+            return
+        booth.display_image(self.image)
+        booth.render_text_bottom(u'Picture %d of %d' % (
+            self.session.photo_count + 1, booth.shot_count), size=100)
+        booth.screen_content = content
+
+    def next(self, button_pressed):
+        if self.time_up():
+            image = self.session.take_picture()
+            if self.session.bursting():
+                return BurstState(self.session, image)
+            return ShowLastCaptureState(self.session, image)
+        else:
+            return self
 
 
 class ShowLastCaptureState(TimedState):
@@ -321,7 +711,7 @@ class ShowLastCaptureState(TimedState):
 
     def next(self, button_pressed):
         if self.time_up():
-            if self.session.photo_count == 4:
+            if self.session.photo_count >= self.session.booth.shot_count:
                 return ShowSessionMontageState(self.session)
             else:
                 return CountdownState(self.session)
@@ -333,29 +723,42 @@ class ShowSessionMontageState(TimedState):
     def __init__(self, session):
         super(ShowSessionMontageState, self).__init__(session, session.booth.montage_display_time)
         self.displayed = False
-        self.saved = False
+        self.job = None
+        self.reported = False
 
     def run(self):
         if not self.displayed:
-            for im in range(1, 5):
-                image = self.session.booth.load_image(self.session.get_image_name(im))
-                size = (self.session.booth.size[0]/2, self.session.booth.size[1]/2)
-                image = pygame.transform.scale(image, size)
-                x_pos = size[0] * ((im - 1) % 2)
-                y_pos = size[1] * (1 if im > 2 else 0)
-                self.session.booth.main_surface.blit(image, (x_pos, y_pos))
+            booth = self.session.booth
+            names = self.session.get_image_names()
+            first_size = self.session.images.get(names[0]).get_size()
+            cells = grid_layout(booth.size, len(names), 0, float(first_size[0]) / first_size[1])
+            booth.main_surface.fill((0, 0, 0))
+            for name, cell in zip(names, cells):
+                booth.main_surface.blit(booth.load_image(name, cell.size), cell)
+            booth.display_extras('montage')
+            self.session.booth.mark_dirty()
             self.displayed = True
-        elif not self.saved:
-            self.session.booth.save_and_print_combined(
+        elif not self.job:
+            self.job = self.session.booth.save_and_print_combined_async(
                 self.session.get_image_name('combined'),
-                [self.session.get_image_name(im) for im in range(1, 5)])
-            self.saved = True
-            if self.session.booth.printer:
-                if self.session.booth.printer.get_error():
-                    print_text = "Check printer!"
+                self.session.get_image_names(),
+                self.session.images)
+            if self.session.booth.animator:
+                self.session.booth.make_animation_async(
+                    self.session.get_image_name('animation'),
+                    self.session.get_image_names())
+        elif not self.reported and self.job.done():
+            self.reported = True
+            printer = self.session.booth.printer
+            if printer:
+                if not self.job.succeeded() or printer.get_error():
+                    self.session.booth.display_overlay('check_printer')
+                elif printer.estimated_wait() > LONG_PRINT_WAIT:
+                    minutes = int(round(printer.estimated_wait() / 60.0))
+                    self.session.booth.render_text_bottom(
+                        "Printing... ready in about %d minutes" % minutes, size=100)
                 else:
-                    print_text = "Printing..."
-                self.session.booth.render_text_bottom(print_text, size=100)
+                    self.session.booth.display_overlay('printing')
 
     def next(self, button_pressed):
         if self.time_up():
@@ -372,9 +775,14 @@ class PhotoSession(object):
         self.capture_start = None
         self.photo_count = 0
         self.session_start = time.time()
+        # Dropped along with the session, once any job using it has finished
+        self.images = ImageCache(booth.read_image)
 
     def do_frame(self, button_pressed):
-        self.state.run()
+        profiler = self.booth.profiler
+        profiler.state = type(self.state).__name__
+        with profiler.phase('draw'):
+            self.state.run()
 
         self.state = self.state.next(button_pressed)
 
@@ -384,6 +792,21 @@ class PhotoSession(object):
     def get_image_name(self, count):
         return self.capture_start.strftime('%Y-%m-%d-%H%M%S') + '-' + str(count) + '.jpg'
 
+    def get_image_names(self):
+        return [self.get_image_name(count) for count in range(1, self.photo_count + 1)]
+
+    def take_picture(self):
+        self.photo_count += 1
+        image_name = self.get_image_name(self.photo_count)
+        self.booth.capture_image(image_name, more_to_come=self.bursting())
+        return image_name
+
+    def bursting(self):
+        """
+        True when the next shot is part of a burst, straight after this one.
+        """
+        return self.booth.burst and self.photo_count < self.booth.shot_count
+
     def finished(self):
         return self.state is None
 
@@ -398,37 +821,105 @@ if __name__ == '__main__':
     parser.add_argument("-p", "--print_count",
                         help="Set number of copies to print", type=int, default=0)
     parser.add_argument("-P", "--printer", help="Set printer to use", default=None)
+    parser.add_argument("--batch_prints", action="store_true",
+                        help="Print strips, two sessions to a sheet")
+    parser.add_argument("--printer_status_interval", type=float, default=STATUS_POLL_INTERVAL,
+                        help="Seconds between checks of the printer's status")
     parser.add_argument("-u", "--upload_to", help="Url to upload images to")
+    parser.add_argument("--keep_camera_open", action="store_true",
+                        help="Keep the camera connection open between shots")
+    parser.add_argument("--upload_originals", action="store_true",
+                        help="Also upload full size images, once the smaller ones are done")
+    parser.add_argument("--web_size", type=int, default=WEB_IMAGE_MAX_SIZE,
+                        help="Longest side of the images uploaded to the web")
+    parser.add_argument("--web_quality", type=int, default=WEB_IMAGE_QUALITY,
+                        help="JPEG quality of the images uploaded to the web")
+    parser.add_argument("--theme", help="JSON file of overlays to add to or replace the defaults")
+    parser.add_argument("--dirty_rects", action="store_true",
+                        help="Only redraw the parts of the screen that change")
+    parser.add_argument("--shots", type=int, default=SHOT_COUNT, help="Photos per session")
+    parser.add_argument("--shot_countdown", type=float,
+                        help="Countdown before each photo after the first, in seconds")
+    parser.add_argument("--burst", action="store_true",
+                        help="Take the photos after the first one straight after each other")
+    parser.add_argument("--burst_interval", type=float, default=BURST_INTERVAL,
+                        help="Seconds between photos in burst mode")
+    parser.add_argument("--animation", choices=['gif', 'mp4'],
+                        help="Also make an animation of each session's photos")
+    parser.add_argument("--gallery", action="store_true",
+                        help="Show earlier sessions on the idle screen")
+    parser.add_argument("--slide_time", type=float, default=SLIDE_TIME,
+                        help="Seconds each earlier session is shown for")
+    parser.add_argument("--fast_start", action="store_true",
+                        help="Show the idle screen while connecting to the camera and printer")
+    parser.add_argument("--profile",
+                        help="CSV file to append frame timings to, every minute. "
+                             "F1 shows them on screen.")
     args = parser.parse_args()
+    if args.shots < 1:
+        parser.error("--shots must be at least 1")
 
     logger.info("Args were: %s", args)
 
-    if args.upload_to and not upload_image_async:
-        print "Failed to find requests library, which is required for uploads."
-        logger.error("Failed to find requests library.")
-        sys.exit(-1)
-
-    if args.debug:
-        camera = DebugCamera()
-    elif args.webcam:
-        camera = WebcamCamera()
-    else:
-        camera = Camera()
+    if args.upload_to:
+        try:
+            import upload
+        except ImportError:
+            print "Failed to find requests library, which is required for uploads."
+            logger.error("Failed to find requests library.")
+            sys.exit(-1)
+
+    def make_camera():
+        if args.debug:
+            return DebugCamera()
+        elif args.webcam:
+            return WebcamCamera()
+        else:
+            return Camera(persistent=args.keep_camera_open)
 
-    if args.print_count:
+    def make_printer():
         if args.printer == 'File':
-            printer = FilePrinter()
+            return FilePrinter()
         else:
-            printer = PyPrinter(args.printer, args.print_count, args.debug)
+            return PyPrinter(args.printer, args.print_count, args.debug,
+                             state_file=os.path.join(args.save_to, 'print_queue.json'),
+                             status_interval=args.printer_status_interval)
+
+    startup = Startup()
+    camera = None
+    printer = None
+    if args.fast_start:
+        startup.add('camera', make_camera)
+        if args.print_count:
+            startup.add('printer', make_printer)
     else:
-        printer = None
+        camera = make_camera()
+        startup.mark('camera')
+        if args.print_count:
+            printer = make_printer()
+            startup.mark('printer')
 
     booth = PhotoBooth(args.save_to,
                        fullscreen=(not args.nofullscreen),
                        debug=args.debug,
                        camera=camera,
                        printer=printer,
-                       upload_to=args.upload_to)
+                       upload_to=args.upload_to,
+                       dirty_rects=args.dirty_rects,
+                       theme=load_theme(args.theme),
+                       upload_originals=args.upload_originals,
+                       web_max_size=args.web_size,
+                       web_quality=args.web_quality,
+                       batch_prints=args.batch_prints,
+                       profile_path=args.profile,
+                       startup=startup,
+                       shot_count=args.shots,
+                       shot_countdown=args.shot_countdown,
+                       burst=args.burst,
+                       burst_interval=args.burst_interval,
+                       animation=args.animation,
+                       gallery=args.gallery,
+                       slide_time=args.slide_time)
     try:
         booth.start()
     except Exception:
@@ -0,0 +1,287 @@
+import StringIO
+import collections
+import threading
+import time
+import logging
+
+import pygame
+
+from profiling import Profiler
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger('photobooth.preview')
+
+STATS_LOG_INTERVAL = 30
+WAKE_SAMPLES = 20
+# Frames can still be on screen while the next ones are decoded
+DECODE_BUFFERS = 3
+
+
+class PreviewDecoder(object):
+    """
+    Turns live view JPEGs into mirrored, screen sized frames, drawing into
+    a few surfaces allocated up front rather than new ones every frame.
+
+    When the frame is at least twice the size of the screen and PIL is
+    available, the JPEG is decoded at a reduced scale (DCT scaling) and then
+    scaled and mirrored in a single nearest-neighbour transform, the same
+    quality as pygame.transform.scale. DCT scaling only goes in halves, so
+    for anything smaller pygame is quicker: it decodes at full size and the
+    mirror is done on whichever side of the scale is smaller.
+
+    Which way to go is decided from the size of the last frame, so frames
+    aren't opened twice to find out.
+    """
+    def __init__(self, size=None, use_pil=True):
+        self.size = size
+        self.use_pil = use_pil and Image is not None
+        self.buffers = []
+        self.next_buffer = 0
+        # Set once we've seen a frame at this screen size
+        self.pil_faster = None
+
+    def set_size(self, size):
+        self.size = size
+        self.buffers = []
+        self.pil_faster = None
+
+    def check_frame_size(self, frame_size):
+        self.pil_faster = (self.use_pil and self.size is not None and
+                           frame_size[0] >= 2 * self.size[0] and
+                           frame_size[1] >= 2 * self.size[1])
+
+    def get_buffer(self, size, like=None):
+        if not self.buffers:
+            # Scaling into a surface needs it to match the source's format
+            self.buffers = [pygame.Surface(size, 0, like) if like else pygame.Surface(size)
+                            for _ in range(DECODE_BUFFERS)]
+        buf = self.buffers[self.next_buffer]
+        self.next_buffer = (self.next_buffer + 1) % len(self.buffers)
+        return buf
+
+    def decode(self, data):
+        if self.pil_faster:
+            image = Image.open(StringIO.StringIO(data))
+            self.check_frame_size(image.size)
+            if self.pil_faster:
+                return self.decode_pil(image)
+        picture = pygame.image.load(StringIO.StringIO(data))
+        self.check_frame_size(picture.get_size())
+        return self.decode_pygame(picture)
+
+    def decode_pil(self, image):
+        size = self.size
+        image.draft('RGB', size)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        # Maps each output pixel back to the input, flipped horizontally
+        width, height = image.size
+        x_scale = float(width) / size[0]
+        y_scale = float(height) / size[1]
+        image = image.transform(size, Image.AFFINE,
+                                (-x_scale, 0, width, 0, y_scale, 0), Image.NEAREST)
+
+        frame = pygame.image.frombuffer(image.tobytes(), size, 'RGB')
+        buf = self.get_buffer(size, frame)
+        buf.blit(frame, (0, 0))
+        return buf
+
+    def decode_pygame(self, picture):
+        if not self.size:
+            return pygame.transform.flip(picture, True, False)
+        if picture.get_width() < self.size[0]:
+            picture = pygame.transform.flip(picture, True, False)
+            return pygame.transform.scale(picture, self.size, self.get_buffer(self.size, picture))
+        picture = pygame.transform.scale(picture, self.size, self.get_buffer(self.size, picture))
+        return pygame.transform.flip(picture, True, False)
+
+
+class PreviewPipeline(threading.Thread):
+    """
+    Pulls live view frames from the camera on a background thread.
+
+    Only the newest frame is kept - if the UI hasn't picked up the previous
+    one by the time the next arrives, the old one is dropped.
+
+    Anything else that talks to the camera (capturing, sleeping) must hold
+    camera_lock while it does so.
+
+    Once the camera has been put to sleep, waking it starts reconnecting in
+    the background straight away. The time from the preview being wanted
+    after a sleep to its first new frame is kept in wake_latencies.
+    """
+    def __init__(self, camera, max_fps=25, profiler=None):
+        super(PreviewPipeline, self).__init__(name='preview')
+        self.daemon = True
+        self.camera = camera
+        self.profiler = profiler or Profiler()
+        self.size = None
+        self.decoder = PreviewDecoder()
+        self.min_frame_time = 1.0 / max_fps
+
+        self.camera_lock = threading.Lock()
+        self.frame_lock = threading.Lock()
+        self.active = threading.Event()
+        self.stopped = False
+
+        self.frame = None
+        self.fresh = False
+        self.asleep = True
+        self.woken_at = None
+        self.wake_latencies = collections.deque(maxlen=WAKE_SAMPLES)
+
+        self.frame_count = 0
+        self.dropped_count = 0
+        self.error_count = 0
+        self.fps = 0.0
+        self.window_start = time.time()
+        self.window_frames = 0
+        self.last_stats_log = time.time()
+
+    def set_size(self, size):
+        self.size = size
+        self.decoder.set_size(size)
+
+    def wake(self):
+        """
+        Start reconnecting to the camera, if it's asleep, so it's ready by
+        the time the preview is wanted.
+        """
+        if not self.asleep:
+            return
+        self.asleep = False
+        self.woken_at = time.time()
+        if hasattr(self.camera, 'wake'):
+            waker = threading.Thread(target=self.wake_camera, name='camera-wake')
+            waker.daemon = True
+            waker.start()
+
+    def wake_camera(self):
+        start = time.time()
+        try:
+            with self.camera_lock:
+                self.camera.wake()
+        except Exception:
+            # The preview will try again when it next captures
+            logger.exception("Failed to wake the camera")
+            return
+        logger.debug("Camera woken in %.2fs", time.time() - start)
+
+    def waking(self):
+        """
+        True from waking the camera until it sends a new frame.
+        """
+        return self.woken_at is not None
+
+    def sleep(self):
+        self.pause()
+        with self.camera_lock:
+            self.camera.sleep()
+        self.asleep = True
+
+    def resume(self):
+        self.wake()
+        if not self.active.is_set():
+            if self.woken_at is not None:
+                # Woken early, so time how long the preview is actually waited for
+                self.woken_at = time.time()
+            self.window_start = time.time()
+            self.window_frames = 0
+            self.active.set()
+
+    def pause(self):
+        self.active.clear()
+
+    def stop(self):
+        self.stopped = True
+        self.active.set()
+
+    def run(self):
+        while not self.stopped:
+            self.active.wait()
+            if self.stopped:
+                break
+
+            frame_start = time.time()
+            try:
+                picture = self.capture()
+            except Exception:
+                self.error_count += 1
+                logger.exception("Failed to capture preview frame")
+                time.sleep(0.5)
+                continue
+
+            self.publish(picture)
+
+            remaining = self.min_frame_time - (time.time() - frame_start)
+            if remaining > 0:
+                time.sleep(remaining)
+
+    def capture(self):
+        if hasattr(self.camera, 'capture_preview_data'):
+            with self.camera_lock, self.profiler.phase('preview_grab'):
+                data = self.camera.capture_preview_data()
+            with self.profiler.phase('preview_decode'):
+                return self.decoder.decode(data)
+
+        with self.camera_lock, self.profiler.phase('preview_grab'):
+            picture = self.camera.capture_preview()
+        with self.profiler.phase('preview_scale'):
+            return self.prepare(picture)
+
+    def prepare(self, picture):
+        if self.size:
+            picture = pygame.transform.scale(picture, self.size)
+        return pygame.transform.flip(picture, True, False)
+
+    def publish(self, picture):
+        with self.frame_lock:
+            if self.fresh:
+                self.dropped_count += 1
+            self.frame = picture
+            self.fresh = True
+        if self.woken_at is not None:
+            latency = time.time() - self.woken_at
+            self.woken_at = None
+            self.wake_latencies.append(latency)
+            logger.info("First preview frame %.2fs after it was wanted", latency)
+        self.frame_count += 1
+        self.update_fps()
+
+    def update_fps(self):
+        now = time.time()
+        self.window_frames += 1
+        elapsed = now - self.window_start
+        if elapsed >= 1:
+            self.fps = self.window_frames / elapsed
+            self.window_frames = 0
+            self.window_start = now
+
+        if now - self.last_stats_log >= STATS_LOG_INTERVAL:
+            self.last_stats_log = now
+            logger.debug("Preview: %.1f fps, %d frames, %d dropped, %d errors",
+                         self.fps, self.frame_count, self.dropped_count, self.error_count)
+
+    def latest(self):
+        """
+        Returns the newest frame, or the last one again if nothing new has
+        arrived. None until the first frame is ready.
+        """
+        with self.frame_lock:
+            self.fresh = False
+            return self.frame
+
+    def stats(self):
+        return {
+            'fps': self.fps,
+            'frames': self.frame_count,
+            'dropped': self.dropped_count,
+            'errors': self.error_count,
+            'wake_latency': (sum(self.wake_latencies) / len(self.wake_latencies)
+                             if self.wake_latencies else None),
+        }
@@ -7,6 +7,11 @@ import time
 import sys
 from printer import CmdPrinter, PyPrinter
 
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
 logger = logging.getLogger('photobooth')
 
 file_log_handler = logging.FileHandler('printer.log')
@@ -20,23 +25,91 @@ logger.addHandler(stdout_log_handler)
 
 logger.setLevel(logging.DEBUG)
 
+DONE_SYNC_BATCH = 10
+DONE_SYNC_INTERVAL = 5
+POLL_INTERVAL = 1
+
+
+class DoneIndex(object):
+    """
+    The names of files already printed, one per line in done.txt.
+
+    Read once at startup and appended to from then on. Each name is
+    flushed as it's written, but only fsynced in batches.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.names = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.names = set(line.strip() for line in f if line.strip())
+        self.file = open(path, 'a')
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def add(self, name):
+        self.names.add(name)
+        self.file.write(name + '\n')
+        self.file.flush()
+        self.unsynced += 1
+        if self.unsynced >= DONE_SYNC_BATCH or time.time() - self.last_sync > DONE_SYNC_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        if self.unsynced:
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+        self.last_sync = time.time()
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+def print_if_new(input_folder, name, printer, done):
+    if name.endswith('.jpg') and name not in done:
+        printer.print_image(os.path.join(input_folder, name))
+        done.add(name)
+
+
 def watch_for_files(input_folder, printer):
-    done_file = os.path.join(input_folder, 'done.txt')
-    if not os.path.exists(done_file):
-        open(done_file, 'a').close()
-    with open(done_file) as f:
-        content = f.readlines()
-    done_files = set([x.strip() for x in content])
+    done = DoneIndex(os.path.join(input_folder, 'done.txt'))
+    try:
+        if INotify:
+            watch_inotify(input_folder, printer, done)
+        else:
+            logger.info("inotify_simple not found, polling %s", input_folder)
+            watch_polling(input_folder, printer, done)
+    finally:
+        done.close()
+
+
+def watch_inotify(input_folder, printer, done):
+    inotify = INotify()
+    inotify.add_watch(input_folder, flags.CLOSE_WRITE | flags.MOVED_TO)
+    logger.info("Watching %s with inotify", input_folder)
+
+    # Catch up on anything that arrived while we weren't watching
+    for name in os.listdir(input_folder):
+        print_if_new(input_folder, name, printer, done)
+
+    while True:
+        events = inotify.read(timeout=DONE_SYNC_INTERVAL * 1000)
+        for event in events:
+            print_if_new(input_folder, event.name, printer, done)
+        if not events:
+            done.sync()
+
+
+def watch_polling(input_folder, printer, done):
     while True:
-        files = os.listdir(input_folder)
-        jpgs = set([f for f in files if f.endswith('.jpg')])
-        for jpg in jpgs:
-            if jpg not in done_files:
-                printer.print_image(os.path.join(input_folder, jpg))
-                with open(done_file, 'a') as f:
-                    f.write(jpg + '\n')
-                done_files.add(jpg)
-        time.sleep(1)
+        for name in os.listdir(input_folder):
+            print_if_new(input_folder, name, printer, done)
+        done.sync()
+        time.sleep(POLL_INTERVAL)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -47,5 +120,9 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     logger.info("Args were: %s", args)
-    printer = PyPrinter(args.printer, args.print_count, False)
-    watch_for_files(args.print_from, printer)
+    printer = PyPrinter(args.printer, args.print_count, False,
+                        state_file=os.path.join(args.print_from, 'print_queue.json'))
+    try:
+        watch_for_files(args.print_from, printer)
+    finally:
+        printer.stop()
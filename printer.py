@@ -1,6 +1,13 @@
 import os
+import collections
+import json
 import logging
 import shutil
+import threading
+import time
+from subprocess import call
+
+from files import write_json
 
 logger = logging.getLogger('photobooth.printer')
 
@@ -13,7 +20,7 @@ class CmdPrinter(object):
     def print_image(self, image_path):
         printing_cmd = ["lpr"]
         if self.name:
-            printing_cmd += ["-P", self.printer]
+            printing_cmd += ["-P", self.name]
         printing_cmd += ["-#", str(self.count), image_path]
 
         logger.info(' '.join(printing_cmd))
@@ -23,14 +30,318 @@ class CmdPrinter(object):
     def get_error(self):
         return None
 
+    def estimated_wait(self):
+        return 0
+
+    def stop(self):
+        pass
+
 PRINTER_STATES = {
     3: 'Idle',
     4: 'Printing',
     5: 'Off'
 }
 
+# IPP job-state values
+JOB_COMPLETED = 9
+JOB_FAILED_STATES = {
+    6: 'Stopped',
+    7: 'Cancelled',
+    8: 'Aborted',
+}
+
+MAX_JOBS_IN_FLIGHT = 2
+MAX_PRINT_ATTEMPTS = 3
+PRINT_SECONDS_PER_SHEET = 45
+JOB_POLL_INTERVAL = 2
+RETRY_BASE_DELAY = 10
+RETRY_MAX_DELAY = 300
+# IPP status when CUPS has no record of a job, e.g. it's been purged from the history
+IPP_NOT_FOUND = 0x0406
+
+
+class PrintScheduler(threading.Thread):
+    """
+    Feeds prints to CUPS a few at a time rather than all at once, keeping
+    track of the jobs it has sent. Failed jobs are sent again after a
+    growing delay, up to max_attempts times. While the printer itself is
+    stopped (out of paper, paused) its stopped jobs are left alone, so they
+    carry on once it's back.
+
+    Everything not yet printed is listed in state_file, so it's picked up
+    again if the booth is restarted. When stopped, anything still waiting
+    is handed straight to CUPS.
+
+    CUPS is only ever called with the lock released, so checking on the
+    scheduler from the UI never waits on it.
+
+    Works with anything that has the printFile, getJobAttributes and
+    cancelJob methods of a cups.Connection.
+    """
+    def __init__(self, connection, printer_name, count, state_file=None, status=None,
+                 max_in_flight=MAX_JOBS_IN_FLIGHT, max_attempts=MAX_PRINT_ATTEMPTS,
+                 seconds_per_print=PRINT_SECONDS_PER_SHEET, poll_interval=JOB_POLL_INTERVAL):
+        super(PrintScheduler, self).__init__(name='print-scheduler')
+        self.daemon = True
+        self.connection = connection
+        self.printer_name = printer_name
+        self.count = count
+        self.state_file = state_file
+        self.status = status
+        self.max_in_flight = max_in_flight
+        self.max_attempts = max_attempts
+        self.seconds_per_print = seconds_per_print
+        self.poll_interval = poll_interval
+
+        self.condition = threading.Condition()
+        self.stopped = False
+        # (path, attempts, ready_at) not yet sent to CUPS
+        self.waiting = collections.deque()
+        # CUPS job id -> (path, attempts, time sent)
+        self.in_flight = {}
+        # Being sent right now, so in neither of the above
+        self.sending = 0
+        # Everything not yet printed, readable without the lock
+        self.outstanding = 0
+        self.last_completed = None
+
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+
+        self.load_state()
+
+    def load_state(self):
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            logger.exception("Failed to read print queue from %s", self.state_file)
+            return
+        now = time.time()
+        with self.condition:
+            # Jobs CUPS already has are followed up, not sent again
+            for job_id, (image_path, attempts) in state.get('in_flight', {}).items():
+                self.in_flight[int(job_id)] = (image_path, attempts, now)
+            for item in state.get('waiting', []):
+                self.waiting.append((item[0], item[1], 0))
+            self.update_outstanding()
+        logger.info("Resuming %d unfinished prints", self.outstanding)
+
+    def save_state(self):
+        # Called with the condition held
+        self.update_outstanding()
+        if not self.state_file:
+            return
+        write_json(self.state_file, {
+            'waiting': [(image_path, attempts) for image_path, attempts, ready_at
+                        in self.waiting],
+            'in_flight': dict((job_id, (image_path, attempts))
+                              for job_id, (image_path, attempts, sent)
+                              in self.in_flight.items()),
+        })
+
+    def update_outstanding(self):
+        # Called with the condition held
+        self.outstanding = len(self.waiting) + len(self.in_flight) + self.sending
+
+    def submit(self, image_path):
+        with self.condition:
+            self.waiting.append((image_path, 0, 0))
+            self.save_state()
+            self.condition.notify()
+
+    def stop(self):
+        """
+        Stop once everything still waiting has been handed to CUPS.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                stopping = self.stopped
+                jobs = dict(self.in_flight)
+            try:
+                self.check_jobs(jobs)
+            except Exception:
+                logger.exception("Print scheduler failed to check on print jobs")
+            try:
+                # Send the lot when stopping, so nothing is left only in memory
+                self.send_waiting(None if stopping else self.max_in_flight)
+            except Exception:
+                logger.exception("Print scheduler failed to send prints")
+            with self.condition:
+                if stopping:
+                    return
+                if not self.stopped:
+                    self.condition.wait(self.poll_interval)
+
+    def check_jobs(self, jobs):
+        """
+        Ask CUPS how each of jobs is doing, without holding the lock.
+        """
+        for job_id, (image_path, attempts, sent) in jobs.items():
+            try:
+                state = self.connection.getJobAttributes(
+                    job_id, requested_attributes=['job-state'])['job-state']
+            except Exception, e:
+                if e.args and e.args[0] == IPP_NOT_FOUND:
+                    # Long gone from the history, so there's nothing to follow up
+                    logger.warn('CUPS has no record of print job %d for %s', job_id, image_path)
+                    state = JOB_COMPLETED
+                else:
+                    logger.warn('Failed to check print job %d for %s: %s', job_id, image_path, e)
+                    continue
+
+            if state == JOB_COMPLETED:
+                with self.condition:
+                    del self.in_flight[job_id]
+                    self.job_completed(image_path, sent)
+                    self.save_state()
+            elif state == 6 and self.printer_stopped():
+                # Not the job's fault, it'll carry on when the printer does
+                logger.debug('Print job %d for %s waiting for the printer', job_id, image_path)
+            elif state in JOB_FAILED_STATES:
+                logger.warn('Print job %d for %s %s', job_id, image_path, JOB_FAILED_STATES[state])
+                if state == 6:
+                    # Stopped jobs would otherwise sit in the queue forever
+                    try:
+                        self.connection.cancelJob(job_id)
+                    except Exception:
+                        logger.exception('Failed to cancel print job %d', job_id)
+                with self.condition:
+                    del self.in_flight[job_id]
+                    self.job_failed(image_path, attempts + 1)
+                    self.save_state()
+
+    def printer_stopped(self):
+        return self.status is not None and self.status.is_stopped()
+
+    def job_completed(self, image_path, sent):
+        # Called with the condition held
+        now = time.time()
+        started = max(sent, self.last_completed or sent)
+        # Keep a running average of how long each print really takes
+        self.seconds_per_print = 0.8 * self.seconds_per_print + 0.2 * (now - started)
+        self.last_completed = now
+        self.completed += 1
+        logger.info('Printed %s, about %.0fs per print', image_path, self.seconds_per_print)
+
+    def job_failed(self, image_path, attempts):
+        # Called with the condition held
+        if attempts < self.max_attempts:
+            self.retried += 1
+            delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+            logger.info('Requeueing %s in %ds, attempt %d', image_path, delay, attempts + 1)
+            self.waiting.appendleft((image_path, attempts, time.time() + delay))
+        else:
+            self.failed += 1
+            logger.error('Giving up printing %s after %d attempts', image_path, attempts)
+
+    def send_waiting(self, max_in_flight):
+        """
+        Hand prints that are ready to CUPS until max_in_flight are in
+        progress. If it's None, send all of them, ready or not. printFile
+        uploads the whole image, so it's called without the lock.
+        """
+        while True:
+            with self.condition:
+                if max_in_flight is None:
+                    ready = self.waiting
+                elif len(self.in_flight) >= max_in_flight:
+                    return
+                else:
+                    now = time.time()
+                    ready = [item for item in self.waiting if item[2] <= now]
+                if not ready:
+                    return
+                item = ready[0]
+                self.waiting.remove(item)
+                image_path, attempts, ready_at = item
+                self.sending += 1
+
+            try:
+                job_id = self.connection.printFile(self.printer_name, image_path, image_path,
+                                                   {"copies": str(self.count)})
+            except Exception:
+                logger.exception("Printing failed for %s", image_path)
+                job_id = None
+
+            with self.condition:
+                self.sending -= 1
+                if job_id is None:
+                    self.job_failed(image_path, attempts + 1)
+                else:
+                    logger.info('Sent %s to the printer as job %d', image_path, job_id)
+                    self.in_flight[job_id] = (image_path, attempts, time.time())
+                self.save_state()
+
+    def estimated_wait(self):
+        """
+        Roughly how many seconds until everything submitted so far has printed.
+        """
+        return self.outstanding * self.seconds_per_print
+
+    def stats(self):
+        with self.condition:
+            return {
+                'waiting': len(self.waiting),
+                'in_flight': len(self.in_flight),
+                'completed': self.completed,
+                'retried': self.retried,
+                'failed': self.failed,
+                'seconds_per_print': self.seconds_per_print,
+            }
+
+
+STATUS_POLL_INTERVAL = 5
+
+
+class PrinterStatus(threading.Thread):
+    """
+    Keeps a copy of the printer's attributes up to date in the background,
+    so reading them never waits on CUPS.
+    """
+    def __init__(self, connection, printer_name, interval=STATUS_POLL_INTERVAL):
+        super(PrinterStatus, self).__init__(name='printer-status')
+        self.daemon = True
+        self.connection = connection
+        self.printer_name = printer_name
+        self.interval = interval
+        self.attributes = {}
+        self.updated = 0
+        self.stopped = threading.Event()
+
+    def refresh(self):
+        # One call gets everything we need about every printer
+        self.attributes = self.connection.getPrinters().get(self.printer_name, {})
+        self.updated = time.time()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Failed to get printer status")
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+    def is_stale(self):
+        return time.time() - self.updated > 3 * self.interval
+
+    def is_stopped(self):
+        return not self.is_stale() and self.attributes.get('printer-state') == 5
+
+
 class PyPrinter(object):
-    def __init__(self, name, count, debug):
+    def __init__(self, name, count, debug, state_file=None, status_interval=STATUS_POLL_INTERVAL):
         import cups
     
         self.connection = cups.Connection()
@@ -43,16 +354,30 @@ class PyPrinter(object):
         if self.name not in self.connection.getPrinters():
             raise Exception("Printer not found: " + str(self.name))
 
+        # The background threads have their own connections, as they aren't thread safe
+        self.status = PrinterStatus(cups.Connection(), self.name, status_interval)
+        self.status.refresh()
+        self.status.start()
+        self.scheduler = PrintScheduler(cups.Connection(), self.name, self.count, state_file,
+                                        self.status)
+        self.scheduler.start()
+
     def get_printer(self):
-        return self.connection.getPrinters()[self.name]
+        return self.status.attributes
 
     def get_state(self):
-        state = self.get_printer()['printer-state']
+        if self.status.is_stale():
+            logger.warn('Printer status is out of date, last updated %.0fs ago',
+                        time.time() - self.status.updated)
+            return 'Unknown'
+
+        printer = self.get_printer()
+        state = printer.get('printer-state')
         
-        logger.info('Printer state: %i', state)
+        logger.info('Printer state: %s', state)
         if state not in PRINTER_STATES:
-            reason = self.get_printer()['printer-state-reasons']
-            message = self.get_printer()['printer-state-message']
+            reason = printer.get('printer-state-reasons')
+            message = printer.get('printer-state-message')
             logger.warn('Unknown printer state: %s message %s reason %s', state, message, reason)
         
         return PRINTER_STATES.get(state, 'Unknown')
@@ -68,11 +393,19 @@ class PyPrinter(object):
         if self.debug:
             logger.info('Would be printing! %s', image_path)
         else:
-            try:
-                logger.info('Printing: %s', image_path)
-                self.connection.printFile(self.name, image_path, image_path, {"copies": str(self.count)})
-            except:
-                logger.exception("Printing failed for %s", image_path)
+            logger.info('Printing: %s', image_path)
+            self.scheduler.submit(image_path)
+
+    def estimated_wait(self):
+        return self.scheduler.estimated_wait()
+
+    def stop(self):
+        """
+        Hand anything still waiting to CUPS and stop the background threads.
+        """
+        self.scheduler.stop()
+        self.scheduler.join()
+        self.status.stop()
 
 class FilePrinter(object):
     def __init__(self):
@@ -81,6 +414,12 @@ class FilePrinter(object):
     def get_error(self):
         return None
 
+    def estimated_wait(self):
+        return 0
+
+    def stop(self):
+        pass
+
     def print_image(self, image_path):
         folder = os.path.join(os.path.dirname(image_path), 'prints')
         if not os.path.exists(folder):
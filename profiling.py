@@ -0,0 +1,80 @@
+import collections
+import contextlib
+import csv
+import os
+import threading
+import time
+import logging
+
+logger = logging.getLogger('photobooth.profiling')
+
+PROFILE_SAMPLES = 5000
+DUMP_INTERVAL = 60
+
+
+class Profiler(object):
+    """
+    Records how long each phase of the work takes (preview grab, decode,
+    text, flip, capture, composition...) against the session state that
+    was current at the time, in a ring buffer.
+
+    Safe to record from any thread.
+    """
+    def __init__(self, dump_path=None, size=PROFILE_SAMPLES):
+        self.samples = collections.deque(maxlen=size)
+        self.state = 'Idle'
+        self.dump_path = dump_path
+        self.dumped_up_to = 0
+        self.last_dump = time.time()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def record(self, phase, duration, state=None):
+        self.samples.append((time.time(), state or self.state, phase, duration))
+
+    def summary(self, window=None):
+        """
+        Count, mean and max in ms for each (state, phase), over the last
+        window seconds or everything still in the buffer.
+        """
+        cutoff = time.time() - window if window else 0
+        durations = collections.defaultdict(list)
+        for timestamp, state, phase, duration in list(self.samples):
+            if timestamp >= cutoff:
+                durations[(state, phase)].append(duration)
+        return dict((key, {'count': len(values),
+                           'mean': 1000 * sum(values) / len(values),
+                           'max': 1000 * max(values)})
+                    for key, values in durations.items())
+
+    def maybe_dump(self):
+        if self.dump_path and time.time() - self.last_dump >= DUMP_INTERVAL:
+            self.dump()
+
+    def dump(self):
+        """
+        Append everything recorded since the last dump to the CSV file.
+        """
+        self.last_dump = time.time()
+        if not self.dump_path:
+            return
+        with self.lock:
+            samples = [sample for sample in list(self.samples) if sample[0] > self.dumped_up_to]
+            if not samples:
+                return
+            self.dumped_up_to = samples[-1][0]
+            new_file = not os.path.exists(self.dump_path)
+            with open(self.dump_path, 'ab') as f:
+                writer = csv.writer(f)
+                if new_file:
+                    writer.writerow(['time', 'state', 'phase', 'ms'])
+                for timestamp, state, phase, duration in samples:
+                    writer.writerow(['%.3f' % timestamp, state, phase, '%.2f' % (duration * 1000)])
+        logger.debug("Dumped %d profile samples to %s", len(samples), self.dump_path)
@@ -0,0 +1,87 @@
+import collections
+import threading
+import time
+import logging
+
+logger = logging.getLogger('photobooth.startup')
+
+
+class StartupTask(threading.Thread):
+    def __init__(self, name, func, args):
+        super(StartupTask, self).__init__(name='startup-' + name)
+        self.daemon = True
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+        self.started = None
+        self.duration = None
+        self.finished = threading.Event()
+
+    def run(self):
+        self.started = time.time()
+        try:
+            self.result = self.func(*self.args)
+        except Exception, e:
+            self.error = e
+            logger.exception("Startup task %s failed", self.name)
+        finally:
+            self.duration = time.time() - self.started
+            self.finished.set()
+
+
+class Startup(object):
+    """
+    Runs the slow parts of starting up (connecting to the camera, printer
+    and button) on background threads, so there can be something on the
+    screen straight away. A task's result can be picked up once
+    ready(name) is true.
+
+    Also keeps how long everything took, to log once it's all done.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.tasks = collections.OrderedDict()
+        self.marks = collections.OrderedDict()
+        self.logged = False
+
+    def add(self, name, func, *args):
+        task = StartupTask(name, func, args)
+        self.tasks[name] = task
+        task.start()
+
+    def mark(self, name):
+        """
+        Note that something done on the main thread has finished.
+        """
+        self.marks[name] = time.time() - self.started
+
+    def ready(self, name):
+        task = self.tasks.get(name)
+        return task is not None and task.finished.is_set() and task.error is None
+
+    def result(self, name):
+        return self.tasks[name].result
+
+    def check(self):
+        """
+        Raises the error from the first task that failed, if any.
+        """
+        for task in self.tasks.values():
+            if task.finished.is_set() and task.error is not None:
+                raise task.error
+
+    def done(self):
+        return all(task.finished.is_set() for task in self.tasks.values())
+
+    def log_when_done(self):
+        if self.logged or not self.done():
+            return
+        self.logged = True
+        ends = self.marks.values()
+        times = ['%s at %.2fs' % item for item in self.marks.items()]
+        for name, task in self.tasks.items():
+            start = task.started - self.started
+            ends.append(start + task.duration)
+            times.append('%s %.2fs (%.2fs to %.2fs)' % (name, task.duration, start, ends[-1]))
+        logger.info("Startup took %.2fs: %s", max(ends or [0]), ', '.join(times))
@@ -0,0 +1,58 @@
+import collections
+import logging
+
+import pygame
+
+logger = logging.getLogger('photobooth.text')
+
+TEXT_COLOUR = (210, 210, 210)
+MAX_CACHED_LINES = 64
+
+
+class TextRenderer(object):
+    """
+    Caches fonts and rendered lines of text.
+
+    SysFont scans the system fonts every time it's called, and the booth
+    only ever shows a handful of different strings, so both are worth
+    keeping around.
+    """
+    def __init__(self, max_lines=MAX_CACHED_LINES):
+        self.fonts = {}
+        self.lines = collections.OrderedDict()
+        self.max_lines = max_lines
+        self.hits = 0
+        self.misses = 0
+
+    def get_font(self, size, name=None):
+        name = name or pygame.font.get_default_font()
+        key = (name, size)
+        font = self.fonts.get(key)
+        if font is None:
+            font = pygame.font.SysFont(name, size)
+            self.fonts[key] = font
+        return font
+
+    def render(self, text, size, colour=TEXT_COLOUR):
+        key = (text, size, colour)
+        line = self.lines.pop(key, None)
+        if line is None:
+            self.misses += 1
+            line = self.get_font(size).render(text, 1, colour)
+            if len(self.lines) >= self.max_lines:
+                self.lines.popitem(last=False)
+        else:
+            self.hits += 1
+        self.lines[key] = line
+        return line
+
+    def line_height(self, size):
+        return self.get_font(size).get_linesize()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'fonts': len(self.fonts),
+            'lines': len(self.lines),
+        }
@@ -1,31 +1,213 @@
-
 import requests
+import collections
+import json
+import os
 import threading
+import time
 import logging
 
+from files import write_json
+
 logger = logging.getLogger('photobooth.upload')
 
 PHOTO_API_KEY = '''TODO: Your API key here'''
 
+UPLOAD_WORKERS = 2
+UPLOAD_TIMEOUT = 60
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 300
+
 
-def upload_image_async(upload_to, file_path):
-    UploadThread(upload_to, file_path).start()
+class UploadQueue(object):
+    """
+    Uploads images on a small pool of worker threads, each keeping its
+    own connection open between uploads.
 
+    Failed uploads are retried with exponential backoff. Everything not yet
+    uploaded is listed in state_file, so it gets picked up again if the
+    booth is restarted.
 
-class UploadThread(threading.Thread):
-    def __init__(self, url, file_path):
-        super(UploadThread, self).__init__()
+    Files with a higher priority number are only sent once nothing with a
+    lower one is left to do.
+    """
+    def __init__(self, url, state_file, workers=UPLOAD_WORKERS):
         self.url = url
-        self.file_path = file_path
-
-    def run(self):
-        logger.info("Uploading to website: %s", self.file_path)
-        with open(self.file_path, 'rb') as f:
-            files = {'file': f}
-            headers = {'X-API-TOKEN': PHOTO_API_KEY}
-            try:
-                r = requests.post(self.url, files=files, headers=headers)
-                r.raise_for_status()
-                logger.info("Uploaded %s successfully", self.file_path)
-            except Exception:
-                logger.exception("Failed to upload %s. ", self.file_path)
+        self.state_file = state_file
+        self.worker_count = workers
+        self.workers = []
+        self.stopped = False
+
+        self.condition = threading.Condition()
+        # (priority, ready_at, sequence, path) for everything not in progress
+        self.waiting = []
+        self.sequence = 0
+        # Everything not yet uploaded, including what's in progress
+        self.priorities = {}
+        self.attempts = {}
+        self.queued_at = {}
+
+        self.uploaded = 0
+        self.failures = 0
+        self.bytes_sent = 0
+        self.upload_time = 0.0
+        self.history = collections.deque(maxlen=100)
+
+        self.load_state()
+
+    def load_state(self):
+        if not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file) as f:
+                pending = json.load(f)
+        except (IOError, ValueError):
+            logger.exception("Failed to read upload queue from %s", self.state_file)
+            return
+        if isinstance(pending, list):
+            pending = dict((path, 0) for path in pending)
+        with self.condition:
+            for path, priority in pending.items():
+                self.queue(path, priority)
+        logger.info("Resuming %d pending uploads", len(pending))
+
+    def save_state(self):
+        # Called with the condition held
+        write_json(self.state_file, self.priorities)
+
+    def queue(self, path, priority):
+        # Called with the condition held
+        if path in self.priorities:
+            # Already on its way
+            return
+        self.priorities[path] = priority
+        self.attempts[path] = 0
+        self.queued_at[path] = time.time()
+        self.schedule(path, time.time())
+
+    def schedule(self, path, ready_at):
+        # Called with the condition held
+        self.sequence += 1
+        self.waiting.append((self.priorities[path], ready_at, self.sequence, path))
+
+    def add(self, path, priority=0):
+        with self.condition:
+            self.queue(path, priority)
+            self.save_state()
+            self.condition.notify_all()
+
+    def start(self):
+        for i in range(self.worker_count):
+            worker = threading.Thread(target=self.work, name='upload-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        """
+        Stop the workers. Anything still pending stays in the state file.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def next_path(self):
+        with self.condition:
+            while not self.stopped:
+                now = time.time()
+                top = min(self.priorities.values()) if self.priorities else None
+                candidates = [item for item in self.waiting if item[0] == top]
+                ready = [item for item in candidates if item[1] <= now]
+                if ready:
+                    item = min(ready)
+                    self.waiting.remove(item)
+                    return item[3]
+                elif candidates:
+                    self.condition.wait(min(item[1] for item in candidates) - now)
+                else:
+                    self.condition.wait()
+            return None
+
+    def work(self):
+        session = requests.Session()
+        session.headers['X-API-TOKEN'] = PHOTO_API_KEY
+        while True:
+            path = self.next_path()
+            if path is None:
+                return
+            self.upload(session, path)
+
+    def upload(self, session, path):
+        if not os.path.exists(path):
+            logger.error("Not uploading %s, it no longer exists", path)
+            self.finish(path)
+            return
+
+        logger.info("Uploading to website: %s", path)
+        start = time.time()
+        try:
+            with open(path, 'rb') as f:
+                r = session.post(self.url, files={'file': f}, timeout=UPLOAD_TIMEOUT)
+            r.raise_for_status()
+        except requests.HTTPError, e:
+            status = e.response.status_code
+            if 400 <= status < 500 and status not in (408, 429):
+                logger.exception("Upload of %s was rejected, giving up", path)
+                self.finish(path)
+            else:
+                logger.exception("Failed to upload %s", path)
+                self.retry(path)
+            return
+        except Exception:
+            logger.exception("Failed to upload %s", path)
+            self.retry(path)
+            return
+
+        elapsed = time.time() - start
+        size = os.path.getsize(path)
+        with self.condition:
+            self.uploaded += 1
+            self.bytes_sent += size
+            self.upload_time += elapsed
+            latency = time.time() - self.queued_at[path]
+            self.history.append({
+                'path': path,
+                'bytes': size,
+                'upload_time': elapsed,
+                'latency': latency,
+                'attempts': self.attempts[path] + 1,
+            })
+        logger.info("Uploaded %s successfully, %d bytes in %.1fs, %.1fs after it was queued",
+                    path, size, elapsed, latency)
+        self.finish(path)
+
+    def retry(self, path):
+        with self.condition:
+            self.failures += 1
+            self.attempts[path] += 1
+            delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (self.attempts[path] - 1))
+            logger.info("Retrying %s in %ds", path, delay)
+            self.schedule(path, time.time() + delay)
+            self.condition.notify()
+
+    def finish(self, path):
+        with self.condition:
+            del self.priorities[path]
+            del self.attempts[path]
+            del self.queued_at[path]
+            self.save_state()
+            # Lower priority files may be able to go now
+            self.condition.notify_all()
+
+    def depth(self):
+        return len(self.priorities)
+
+    def stats(self):
+        with self.condition:
+            return {
+                'depth': len(self.priorities),
+                'uploaded': self.uploaded,
+                'failures': self.failures,
+                'bytes_sent': self.bytes_sent,
+                'bytes_per_second': self.bytes_sent / self.upload_time if self.upload_time else 0,
+                'recent': list(self.history)[-5:],
+            }